@@ -10,6 +10,7 @@ module.exports = {
         'SVG': false,
         "Util": false,
         "Network": false,
+        "BinaryResponse": false,
         "SimpleComponent": false,
         "_": false,
         "SimpleEventHandler": false,
@@ -136,10 +136,10 @@ class LSTMController {
         const fillRight = Math.ceil((this.windowSize.width - 60) / this.cellWidth) - this.params.get('left');
         payload.set('right', fillRight);
 
-        Network.ajax_request(this.apiURL + '/context')
+        Network.ajax_request(this.apiURL + '/context', BinaryResponse.requestOptions)
           .get(payload)
           .then(d => {
-              this.context = JSON.parse(d);
+              this.context = BinaryResponse.decode(d);
               this.eventHandler.trigger(LSTMController.events.newContextAvailable, {keepSelectedCells});
           })
 
@@ -157,10 +157,10 @@ class LSTMController {
             matchPayload.set('dims', [...(metaDims.map(d => 'meta_' + d)), 'states', 'cell_count', 'words']);
             matchPayload.set('mode', mode);
 
-            Network.ajax_request(this.apiURL + '/match')
+            Network.ajax_request(this.apiURL + '/match', BinaryResponse.requestOptions)
               .get(matchPayload)
               .then(matchResponse => {
-                  this.matchResult = JSON.parse(matchResponse);
+                  this.matchResult = BinaryResponse.decode(matchResponse);
 
                   console.log(this.matchResult, '\n-- matchResult --');
                   this.eventHandler.trigger(LSTMController.events.newMatchingResults, {});
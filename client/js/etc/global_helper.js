@@ -185,10 +185,12 @@ class Network {
     /**
      * Generates a Ajax Request object.
      * @param {string} url - the base url
+     * @param {string} accept - value for the Accept header (optional)
+     * @param {string} responseType - XMLHttpRequest response type, e.g. 'arraybuffer' (optional)
      * @returns {{get: (function(*=)), post: (function(*=)), put: (function(*=)), delete: (function(*=))}}
      *  the ajax object that can call get, post, put, delete on the url
      */
-    static ajax_request(url) {
+    static ajax_request(url, {accept = null, responseType = ''} = {}) {
 
         /* Adapted from: https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Global_Objects/Promise
          * EXAMPLE:
@@ -242,6 +244,8 @@ class Network {
 
                 // Debug: console.log('URI', uri, args);
                 client.open(method, uri);
+                client.responseType = responseType;
+                if (accept) client.setRequestHeader('Accept', accept);
                 client.send();
                 client.onload = function () {
                     if (this.status >= 200 && this.status < 300) {
@@ -272,6 +276,85 @@ class Network {
 }
 
 
+/**
+ * Decoder for the binary response format of the LSTMVis API
+ * (see lstmdata/binary_response.py):
+ * 'LSTV' | uint32 header length | JSON header | padding | raw little-endian buffers
+ */
+class BinaryResponse {
+
+    static get requestOptions() {
+        return {
+            accept: 'application/x-lstmvis-binary; dtype=float16, application/json;q=0.5',
+            responseType: 'arraybuffer'
+        }
+    }
+
+    static halfToFloat(h) {
+        const sign = (h & 0x8000) ? -1 : 1;
+        const exponent = (h >> 10) & 0x1f;
+        const fraction = h & 0x3ff;
+
+        if (exponent === 0) return sign * Math.pow(2, -14) * (fraction / 1024);
+        if (exponent === 31) return fraction ? NaN : sign * Infinity;
+
+        return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+    }
+
+    static typedBuffer(arrayBuffer, offset, {dtype, shape}) {
+        const size = shape.reduce((a, b) => a * b, 1);
+        if (dtype === 'float32') return new Float32Array(arrayBuffer, offset, size);
+        if (dtype === 'int32') return new Int32Array(arrayBuffer, offset, size);
+
+        return Float32Array.from(new Uint16Array(arrayBuffer, offset, size), BinaryResponse.halfToFloat);
+    }
+
+    static nested(values, shape) {
+        if (shape.length < 2) return Array.from(values);
+        const rowSize = values.length / shape[0];
+
+        return Util.range(0, shape[0]).map(i =>
+          BinaryResponse.nested(values.subarray(i * rowSize, (i + 1) * rowSize), shape.slice(1)));
+    }
+
+    /**
+     * Decodes a binary response into the same object the JSON response would provide.
+     * @param {ArrayBuffer|string} response - the response (JSON strings are parsed as usual)
+     * @returns {Object} the decoded response
+     */
+    static decode(response) {
+        if (typeof response === 'string') return JSON.parse(response);
+
+        const decoder = new TextDecoder('utf-8');
+        if (decoder.decode(new Uint8Array(response, 0, 4)) !== 'LSTV') {
+            // server answered with JSON
+            return JSON.parse(decoder.decode(new Uint8Array(response)));
+        }
+
+        const headerLength = new DataView(response).getUint32(4, true);
+        const header = JSON.parse(decoder.decode(new Uint8Array(response, 8, headerLength)));
+        const base = 8 + headerLength + ((8 - (headerLength % 8)) % 8);
+
+        const unpack = x => {
+            if (Array.isArray(x)) return x.map(unpack);
+            if (x === null || typeof x !== 'object') return x;
+            if ('__buffer__' in x) {
+                const info = header.buffers[x.__buffer__];
+                const values = BinaryResponse.typedBuffer(response, base + info.offset, info);
+
+                return BinaryResponse.nested(values, info.shape);
+            }
+            const res = {};
+            Object.keys(x).forEach(key => res[key] = unpack(x[key]));
+
+            return res;
+        };
+
+        return unpack(header.payload);
+    }
+}
+
+
 class SimpleEventHandler {
     constructor(element) {
         this.element = element;
@@ -1,19 +1,40 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import connexion
 import numpy as np
+import logging
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
 import yaml
-from flask import send_from_directory, redirect
+from flask import send_from_directory, redirect, Response
+from flask import request as http_request
+from flask import json as flask_json
 import json
 from lstmdata.data_handler import LSTMDataHandler
-import lstmdata.read_index as ri
+import lstmdata.binary_response as br
+import lstmdata.cache as ch
+import lstmdata.http_cache as hc
+import lstmdata.io_pool as io
+import lstmdata.project_manifest as pm
+import lstmdata.result_cache as rc
+import lstmdata.sharded as sharded
 import types
 
 __author__ = 'Hendrik Strobelt'
 
 CONFIG_FILE_NAME = 'lstm.yml'
+CACHE_CONTROL = 'max-age=3600, must-revalidate'  # responses only change with the project files
+INFO_CACHE_CONTROL = 'no-cache'  # always revalidate -- projects can be added between restarts
+VARY = 'Accept, Accept-Encoding'
 data_handlers = {}
-index_map = {}
+project_versions = {}
+info_response = {}
+
+# blocking handler calls run in bounded pools -- long matches can't starve context requests
+io_pools = {}
 
 app = connexion.App(__name__, debug=True)
 
@@ -29,6 +50,13 @@ def get_context(**request):
         if not dh.is_valid_source(request['source']):
             return 'No valid source. Valid are: ' + ' -- '.join(dh.valid_sources()), 404
 
+        # clients can ask for raw buffers instead of JSON number arrays
+        binary_dtype = br.accepted_dtype(http_request.headers.get('Accept'))
+        tag = request_etag(project, binary_dtype)
+        unchanged = not_modified(tag)
+        if unchanged is not None:
+            return unchanged
+
         # cell selection by bitmask vs. cell array
         cells = []
         if 'bitmask' in request:
@@ -36,18 +64,84 @@ def get_context(**request):
         elif 'cells' in request:
             cells = request['cells']
 
-        res = dh.get_dimensions(
-            pos_array=request['pos'],
-            source=request['source'],
-            left=request['left'],
-            right=request['right'],
-            dimensions=request['dims'],
-            data_transform=request['transform'],
-            cells=cells,
-            activation_threshold=request['activation']
-        )
+        try:
+            res = io_pools['context'].run(
+                dh.get_dimensions,
+                pos_array=request['pos'],
+                source=request['source'],
+                left=request['left'],
+                right=request['right'],
+                dimensions=request['dims'],
+                data_transform=request['transform'],
+                cells=cells,
+                activation_threshold=request['activation'],
+                raw=binary_dtype is not None
+            )
+        except io.PoolFull:
+            return busy()
         res['cells'] = cells
-        return {'request': request, 'results': res}
+        return respond({'request': request, 'results': res}, binary_dtype, tag)
+
+
+def respond(payload, binary_dtype=None, tag=None, cache_control=CACHE_CONTROL):
+    """ JSON response or -- if binary_dtype is set -- binary response (see lstmdata.binary_response)
+
+    :param payload: response content
+    :param binary_dtype: float dtype for binary buffers or None
+    :param tag: entity tag of the response (see request_etag)
+    :param cache_control: value for the Cache-Control header
+    """
+    if binary_dtype is None:
+        return encoded_response(flask_json.dumps(payload).encode('utf-8'), 'application/json', tag, cache_control)
+    return encoded_response(br.encode(payload, binary_dtype), br.MIME_TYPE, tag, cache_control)
+
+
+def encoded_response(body, mimetype, tag=None, cache_control=CACHE_CONTROL, gzipped=None):
+    """ response with caching headers -- gzip compressed if the client accepts it
+
+    :param body: serialized response
+    :param mimetype: content type of body
+    :param tag: entity tag of the uncompressed body
+    :param cache_control: value for the Cache-Control header
+    :param gzipped: precomputed compressed body
+    """
+    headers = {'Cache-Control': cache_control, 'Vary': VARY}
+    if hc.accepts_gzip(http_request.headers.get('Accept-Encoding')):
+        gzipped = gzipped if gzipped is not None else hc.compress(body)
+        if gzipped is not None:
+            body = gzipped
+            headers['Content-Encoding'] = 'gzip'
+            tag = hc.gzip_etag(tag) if tag else None
+    if tag:
+        headers['ETag'] = tag
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+def request_etag(project, binary_dtype=None):
+    """ entity tag for the current request -- derived from the project files and the request URL
+
+    :param project: project id
+    :param binary_dtype: float dtype for binary buffers or None
+    :rtype: str
+    """
+    return hc.etag(project_versions.get(project), http_request.full_path, binary_dtype)
+
+
+def not_modified(tag, cache_control=CACHE_CONTROL):
+    """ 304 response if the client already has a valid copy (If-None-Match), None otherwise
+
+    :param tag: entity tag of the uncompressed response
+    :param cache_control: value for the Cache-Control header
+    """
+    matching = hc.matching_etag(http_request.headers.get('If-None-Match'), tag)
+    if matching is None:
+        return None
+    return Response(status=304, headers={'ETag': matching, 'Cache-Control': cache_control, 'Vary': VARY})
+
+
+def busy():
+    return Response('Server busy -- try again later', status=503, headers={'Retry-After': '5'})
+
 
 def cleanup_dict(old_dictionary):
     new_dictionary={}
@@ -64,14 +158,47 @@ def cleanup_dict(old_dictionary):
 
 
 def get_info():
-    res = []
-    for key, project in data_handlers.items():
-        # print key
-        res.append({
-            'project': key,
-            'info':  cleanup_dict(project.config)
+    # projects don't change while the server runs -- serialize and compress only once
+    if not info_response:
+        res = sorted([{'project': key, 'info': project_info(project)} for key, project in data_handlers.items()],
+                     key=lambda x: x['project'])
+        body = flask_json.dumps(res).encode('utf-8')
+        info_response.update({
+            'body': body,
+            'gzip': hc.compress(body),
+            'etag': hc.etag('info', *sorted(k + ':' + v for k, v in project_versions.items()))
         })
-    return sorted(res, key=lambda x: x['project'])
+
+    unchanged = not_modified(info_response['etag'], INFO_CACHE_CONTROL)
+    if unchanged is not None:
+        return unchanged
+    return encoded_response(info_response['body'], 'application/json', info_response['etag'],
+                            INFO_CACHE_CONTROL, info_response['gzip'])
+
+
+def get_cache_stats():
+    return {'states': ch.shared_cache.stats(), 'matches': rc.shared_results.stats()}
+
+
+def get_stats(**request):
+    project = request['project']
+    if project not in data_handlers:
+        return 'No such project', 404
+
+    dh = data_handlers[project]  # type: LSTMDataHandler
+    if not dh.is_valid_source(request['source']):
+        return 'No valid source. Valid are: ' + ' -- '.join(dh.valid_sources()), 404
+
+    tag = request_etag(project)
+    unchanged = not_modified(tag)
+    if unchanged is not None:
+        return unchanged
+
+    res = dh.get_stats(request['source'])
+    if res is None:
+        return 'No statistics for this source -- create them with tools/h5_table_stats.py', 404
+    return respond({'request': request, 'results': res}, tag=tag)
+
 
 def search(**request):
     project = request['project']
@@ -84,9 +211,8 @@ def search(**request):
         # start search either using index or regex
 
         dh = data_handlers[project]
-        if project in index_map:
-            res = ri.query_index(request['q'], request['limit'], request['html'],
-                                 dir=index_map[project])
+        if dh.config['index']:
+            res = dh.index_search(request['q'], request['limit'], request['html'])
         elif dh.config['etc']['regex_search']:
             res = dh.regex_search(request['q'], request['limit'], request['html'])
 
@@ -107,29 +233,41 @@ def match(**request):
         if not dh.is_valid_source(request['source']):
             return 'No valid source', 404
 
-        ranking, meta = dh.query_similar_activations(
-            source=request['source'],
-            cells=request['cells'],
-            activation_threshold=request['activation'],
-            data_transform=request['transform'],
-            phrase_length=request['phrase_length'],
-            add_histograms=True,
-            query_mode=request['mode'],
-            constrain_left=request['constraints'][0] > 0,
-            constrain_right=request['constraints'][1] > 0
-        )
-
-        request_positions = list(map(lambda x: x['pos'], ranking))
-        position_details = dh.get_dimensions(
-            pos_array=request_positions,
-            source=request['source'],
-            left=request['left'],
-            right=request['right'],
-            cells=request['cells'],
-            dimensions=request['dims'],
-            data_transform=request['transform'],
-            activation_threshold=request['activation']
-        )
+        binary_dtype = br.accepted_dtype(http_request.headers.get('Accept'))
+        tag = request_etag(project, binary_dtype)
+        unchanged = not_modified(tag)
+        if unchanged is not None:
+            return unchanged
+
+        try:
+            ranking, meta = io_pools['match'].run(
+                dh.query_similar_activations,
+                source=request['source'],
+                cells=request['cells'],
+                activation_threshold=request['activation'],
+                data_transform=request['transform'],
+                phrase_length=request['phrase_length'],
+                add_histograms=True,
+                query_mode=request['mode'],
+                constrain_left=request['constraints'][0] > 0,
+                constrain_right=request['constraints'][1] > 0
+            )
+
+            request_positions = list(map(lambda x: x['pos'], ranking))
+            position_details = io_pools['context'].run(
+                dh.get_dimensions,
+                pos_array=request_positions,
+                source=request['source'],
+                left=request['left'],
+                right=request['right'],
+                cells=request['cells'],
+                dimensions=request['dims'],
+                data_transform=request['transform'],
+                activation_threshold=request['activation'],
+                raw=binary_dtype is not None
+            )
+        except io.PoolFull:
+            return busy()
 
         res = {
             'rankingDetail': ranking,
@@ -137,7 +275,7 @@ def match(**request):
             'fuzzyLengthHistogram': meta['fuzzy_length_histogram'].tolist(),
             'strictLengthHistogram': meta['strict_length_histogram'].tolist()
         }
-        return {'request': request, 'results': res}
+        return respond({'request': request, 'results': res}, binary_dtype, tag)
 
 
 @app.route('/client/<path:path>')
@@ -153,12 +291,27 @@ def redirect_home():
     return redirect('/client/index.html', code=302)
 
 
-def create_data_handlers(directory):
+def project_info(dh):
+    """ cleaned-up project config as served by /info -- loads the project if there is no manifest entry
+
+    :param dh: the (lazy) data handler
+    :return: info dictionary
+    """
+    if dh.info is None:
+        dh.info = cleanup_dict(dh.config)
+    return dh.info
+
+
+def create_data_handlers(directory, warmup=False, load_workers=4):
     """
     searches for CONFIG_FILE_NAME in all subdirectories of directory
-    and creates data handlers for all of them
+    and creates (lazy) data handlers for all of them. Projects with an
+    up-to-date entry in the manifest are loaded on first use (or in
+    background if warmup is set), all others are loaded in parallel.
 
     :param directory: scan directory
+    :param warmup: load all projects in background
+    :param load_workers: number of threads for loading projects
     :return: null
     """
     project_dirs = []
@@ -166,28 +319,158 @@ def create_data_handlers(directory):
         if CONFIG_FILE_NAME in files:
             project_dirs.append(os.path.abspath(root))
 
-    i = 0
+    manifest = pm.read_manifest(directory)
+    new_manifest = {}
+    stale = []
     for p_dir in project_dirs:
         with open(os.path.join(p_dir, CONFIG_FILE_NAME), 'r') as yf:
             config = yaml.load(yf, Loader=yaml.FullLoader)
-            dh_id = os.path.split(p_dir)[1]
-            data_handlers[dh_id] = LSTMDataHandler(directory=p_dir, config=config)
-            if data_handlers[dh_id].config['index']:
-                index_map[dh_id] = data_handlers[dh_id].config['index_dir']
-        i += 1
+        dh_id = os.path.split(p_dir)[1]
+        fingerprint = pm.fingerprint(p_dir, config, CONFIG_FILE_NAME)
+        project_versions[dh_id] = hc.version(fingerprint)
+        entry = manifest.get(p_dir, {})
+        info = entry.get('info') if entry.get('fingerprint') == fingerprint else None
+
+        data_handlers[dh_id] = pm.LazyDataHandler(directory=p_dir, config=config, info=info)
+        new_manifest[p_dir] = {'fingerprint': fingerprint, 'info': info}
+        if info is None:
+            stale.append(dh_id)
+
+    pool = ThreadPoolExecutor(max_workers=load_workers)
+    for dh_id, info in zip(stale, pool.map(lambda x: project_info(data_handlers[x]), stale)):
+        new_manifest[data_handlers[dh_id].directory]['info'] = info
+    if stale or set(new_manifest) != set(manifest):
+        pm.write_manifest(directory, new_manifest)
 
+    pool.shutdown(wait=False)
+    if warmup:
+        warm_up(load_workers)
+
+
+def warm_up(load_workers=4):
+    """ loads all projects in background
+
+    :param load_workers: number of threads for loading projects
+    """
+    pool = ThreadPoolExecutor(max_workers=load_workers)
+    for dh in data_handlers.values():
+        if not dh.loaded:
+            pool.submit(lambda x: x.handler, dh)
+    pool.shutdown(wait=False)
+
+
+def post_fork(warmup=False, load_workers=4):
+    """ prepares a forked worker process: loaded projects get their own HDF5 handles,
+    memory-mapped states and indices are shared with the master (dictionaries are copied on use).
+    Rows cached by the master are dropped.
+
+    :param warmup: load all projects in background
+    :param load_workers: number of threads for loading projects
+    """
+    for dh in data_handlers.values():
+        if dh.loaded:
+            dh.reopen_files()
+    ch.shared_cache.clear()
+    if warmup:
+        warm_up(load_workers)
+
+
+def share_projects(shm_dir):
+    """ loads all projects and moves their HDF5 states into memory-mapped files,
+    so that workers forked afterwards attach to one copy instead of caching their own
+
+    :param shm_dir: directory for the shared states (should be a tmpfs like /dev/shm)
+    :return: directory that holds the shared states -- remove it on exit
+    """
+    directory = tempfile.mkdtemp(prefix='lstmvis_', dir=shm_dir)
+    for dh_id, dh in sorted(data_handlers.items()):
+        logging.info('sharing states of %s', dh_id)
+        dh.share_states(directory)
+    return directory
 
-app.add_api('lstm_server.yaml')
+
+def serve(args):
+    """ runs the server in args.workers pre-forked worker processes with args.threads threads each
+    (requires gunicorn)
+
+    :param args: parsed command line arguments
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print('multiple workers require gunicorn: pip install gunicorn')
+        sys.exit(-1)
+    import lstm_server  # the module that holds the data handlers (this file might run as __main__)
+
+    shared_dir = lstm_server.share_projects(args.shm_dir) if args.share_states else None
+
+    class LSTMVisApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '127.0.0.1:' + args.port)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('timeout', 600)
+            self.cfg.set('post_fork', lambda server, worker: lstm_server.post_fork(args.warmup, args.load_workers))
+            if shared_dir:
+                self.cfg.set('on_exit', lambda server: shutil.rmtree(shared_dir, ignore_errors=True))
+
+        def load(self):
+            return app.app
+
+    LSTMVisApplication().run()
+
+
+def start(args):
+    """ configures caches and pools and creates the data handlers -- runs once in the server process
+
+    :param args: parsed command line arguments
+    """
+    ch.shared_cache.max_bytes = 0 if args.nocache else args.cache_mb * ch.MB
+    rc.shared_results.max_bytes = 0 if args.nocache else args.match_cache_mb * rc.MB
+    rc.shared_results.set_directory(args.match_cache_dir)
+    sharded.set_workers(args.match_workers)
+    io_pools['context'] = io.BoundedPool('context', max_workers=args.io_threads, max_pending=args.queue_size)
+    io_pools['match'] = io.BoundedPool('match', max_workers=args.match_threads, max_pending=args.queue_size)
+    # forked workers warm up themselves (see post_fork)
+    create_data_handlers(args.dir, warmup=args.warmup and args.workers <= 1, load_workers=args.load_workers)
+
+
+def is_worker_process():
+    """ processes spawned by multiprocessing (e.g. for sharded matching) import the main script as
+    __mp_main__ before they start -- they must not scan the data directory again """
+    main_module = sys.modules.get('__mp_main__')  # an alias of __main__ in all other processes
+    return getattr(main_module, '__name__', None) == '__mp_main__' or multiprocessing.parent_process() is not None
+
+
+if not is_worker_process():
+    app.add_api('lstm_server.yaml')
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--nodebug", default=False)
 parser.add_argument("--port", default="8888")
 parser.add_argument("--nocache", default=False)
+parser.add_argument("--cache_mb", type=int, default=1024, help="byte budget (MB) for cached state rows")
+parser.add_argument("--match_cache_mb", type=int, default=64, help="byte budget (MB) for cached match results")
+parser.add_argument("--match_cache_dir", type=str, default=None, help="directory to persist match results")
+parser.add_argument("--warmup", default=False, help="load all projects in background after start")
+parser.add_argument("--load_workers", type=int, default=4, help="threads for loading projects")
+parser.add_argument("--match_workers", type=int, default=0, help="processes for precise matching (0: off)")
+parser.add_argument("--workers", type=int, default=1, help="server processes (more than 1 requires gunicorn)")
+parser.add_argument("--threads", type=int, default=8, help="request threads per server process")
+parser.add_argument("--io_threads", type=int, default=8, help="threads for reading contexts")
+parser.add_argument("--match_threads", type=int, default=2, help="threads for concurrent matches")
+parser.add_argument("--queue_size", type=int, default=32, help="waiting requests per pool before 503")
+parser.add_argument("--share_states", default=False,
+                    help="load all projects before forking workers and share their states in memory")
+parser.add_argument("--shm_dir", type=str, default='/dev/shm' if os.path.isdir('/dev/shm') else None,
+                    help="directory for shared states")
 parser.add_argument("-dir", type=str, default=os.path.abspath('data'))
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    app.run(port=int(args.port), debug=not args.nodebug, host="127.0.0.1")
-else:
-    args, _ = parser.parse_known_args()
-    create_data_handlers(args.dir)
+    if args.workers > 1:
+        serve(args)
+    else:
+        app.run(port=int(args.port), debug=not args.nodebug, host="127.0.0.1", threaded=True)
+elif not is_worker_process():
+    start(parser.parse_known_args()[0])
@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+INDEX_DIR_NAME = 'activation_index'
+MANIFEST_FILE_NAME = 'manifest.json'
+MAX_ROWS = 100000
+
+# index kinds
+BITS = 'bits'
+INTERVALS = 'intervals'
+
+# number of set bits for each possible byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def index_key(source, data_transform, activation_threshold):
+    """ key under which a bit-packed activation index is registered
+
+    :param source: source id in the format file::path
+    :param data_transform: data transformation (tanh, none)
+    :param activation_threshold: activation threshold
+    :return: hashable key
+    :rtype: tuple
+    """
+    return source, data_transform, '{:g}'.format(float(activation_threshold))
+
+
+def index_file_name(source, data_transform, activation_threshold):
+    """ file name for a bit-packed activation index inside INDEX_DIR_NAME
+
+    :return: file name
+    :rtype: str
+    """
+    source, data_transform, threshold = index_key(source, data_transform, activation_threshold)
+    source = source.replace('::', '__').replace('/', '.')
+    return '{0}__{1}__{2}.npy'.format(source, data_transform, threshold)
+
+
+def corrected_threshold(activation_threshold, data_transformed=False):
+    """ threshold on the stored values that corresponds to activation_threshold
+    on transformed values -- same rule as in LSTMDataHandler.query_similar_activations
+
+    :param activation_threshold: activation threshold on transformed values
+    :param data_transformed: True if the stored values are already transformed
+    :return: threshold applicable to stored values
+    """
+    if data_transformed:
+        return activation_threshold
+    return np.arctanh(activation_threshold)
+
+
+def build_index(cell_states, out_file_name, threshold_corrected):
+    """ writes a bit-packed activation index (one bit per cell and time step) for a state matrix
+
+    :param cell_states: state matrix (time steps x cells), e.g. an HDF5 dataset
+    :param out_file_name: .npy output file
+    :param threshold_corrected: threshold applicable to the values in cell_states
+    :return: shape of the written index
+    """
+    n_steps, n_cells = cell_states.shape
+    packed = np.lib.format.open_memmap(out_file_name, mode='w+', dtype=np.uint8,
+                                       shape=(n_steps, int(np.ceil(n_cells / 8.))))
+    slice_offset = 0
+    while slice_offset < n_steps:
+        slice_end = min(slice_offset + MAX_ROWS, n_steps)
+        # same comparison as hf.threshold_discrete
+        active = ~(np.asarray(cell_states[slice_offset:slice_end]) < threshold_corrected)
+        packed[slice_offset:slice_end] = np.packbits(active, axis=1)
+        slice_offset = slice_end
+        logging.info('slice: %i', slice_offset)
+
+    packed.flush()
+    shape = packed.shape
+    del packed
+    return shape
+
+
+def interval_file_names(base_name):
+    """ files of an interval index: start and end (exclusive) of all on-intervals
+    sorted by cell and time, and offsets of each cell into them
+
+    :param base_name: file name without extension
+    :return: (starts file, ends file, offsets file)
+    """
+    return base_name + '.starts.npy', base_name + '.ends.npy', base_name + '.offsets.npy'
+
+
+def _interval_slices(cell_states, threshold_corrected):
+    """ on-intervals of a state matrix, slice by slice -- intervals that are still on at the end are closed
+    at the last time step
+
+    :param cell_states: state matrix (time steps x cells), e.g. an HDF5 dataset
+    :param threshold_corrected: threshold applicable to the values in cell_states
+    :return: generator of ((start cells, start times), (end cells, end times)) -- sorted by cell and time
+    """
+    n_steps, n_cells = cell_states.shape
+    previous = np.zeros((1, n_cells), dtype=np.int8)
+    slice_offset = 0
+    while slice_offset < n_steps:
+        slice_end = min(slice_offset + MAX_ROWS, n_steps)
+        # same comparison as hf.threshold_discrete
+        active = (~(np.asarray(cell_states[slice_offset:slice_end]) < threshold_corrected)).astype(np.int8)
+        change = np.diff(np.concatenate([previous, active]), axis=0)
+        previous = active[-1:]
+        # (cell, time) pairs -- transposed to get them sorted by cell within the slice
+        on_cells, on_times = np.nonzero(change.T == 1)
+        off_cells, off_times = np.nonzero(change.T == -1)
+        yield (on_cells, on_times + slice_offset), (off_cells, off_times + slice_offset)
+        slice_offset = slice_end
+        logging.info('slice: %i', slice_offset)
+
+    open_cells = np.nonzero(previous[0])[0]
+    yield (open_cells[:0], open_cells[:0]), (open_cells, np.full(len(open_cells), n_steps))
+
+
+def build_intervals(cell_states, out_base_name, threshold_corrected):
+    """ writes an interval index -- the sorted on-intervals of each cell -- for a state matrix
+
+    Reads the states twice: the first pass counts the intervals of each cell, the second pass
+    writes them to their place in the memory-mapped output. Memory use is independent of the
+    number of intervals (one slice of MAX_ROWS time steps plus a few arrays of length cells).
+
+    :param cell_states: state matrix (time steps x cells), e.g. an HDF5 dataset
+    :param out_base_name: output file name without extension, see interval_file_names
+    :param threshold_corrected: threshold applicable to the values in cell_states
+    :return: number of intervals
+    """
+    n_cells = cell_states.shape[1]
+    counts = np.zeros(n_cells, dtype=np.int64)
+    for (on_cells, _), _ in _interval_slices(cell_states, threshold_corrected):
+        counts += np.bincount(on_cells, minlength=n_cells)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    starts_file, ends_file, offsets_file = interval_file_names(out_base_name)
+    starts = np.lib.format.open_memmap(starts_file, mode='w+', dtype=np.int64, shape=(int(offsets[-1]),))
+    ends = np.lib.format.open_memmap(ends_file, mode='w+', dtype=np.int64, shape=(int(offsets[-1]),))
+    start_cursor = offsets[:-1].copy()
+    end_cursor = offsets[:-1].copy()
+    for slice_starts, slice_ends in _interval_slices(cell_states, threshold_corrected):
+        for (cells, times), out, cursor in [(slice_starts, starts, start_cursor), (slice_ends, ends, end_cursor)]:
+            # next free place of each cell plus rank within the cell's pairs of this slice
+            out[cursor[cells] + np.arange(len(cells)) - np.searchsorted(cells, cells)] = times
+            cursor += np.bincount(cells, minlength=n_cells)
+    starts.flush()
+    ends.flush()
+    del starts, ends
+    np.save(offsets_file, offsets)
+
+    return int(offsets[-1])
+
+
+def count_active_runs(intervals, cells, length):
+    """ run length encoding of the number of active cells (out of cells) for each time step
+    in [0, length) -- computed by a sweep over the on-intervals of the cells
+
+    :param intervals: interval index (starts, ends, offsets)
+    :param cells: list of cell indices
+    :param length: number of time steps
+    :returns: tuple (runlengths, startpositions, values) -- same as hf.rle
+    """
+    starts, ends, offsets = intervals
+    events = np.concatenate([starts[offsets[c]:offsets[c + 1]] for c in cells] +
+                            [ends[offsets[c]:offsets[c + 1]] for c in cells])
+    n_starts = sum(offsets[c + 1] - offsets[c] for c in cells)
+    deltas = np.ones(len(events), dtype=np.int64)
+    deltas[n_starts:] = -1
+
+    order = np.argsort(events, kind='stable')
+    events = events[order]
+    deltas = deltas[order]
+    change_positions, first = np.unique(events, return_index=True)
+    if len(change_positions) > 0:
+        net = np.add.reduceat(deltas, first)
+        counts = np.cumsum(net)
+        keep = (net != 0) & (change_positions < length)
+        change_positions = change_positions[keep]
+        counts = counts[keep]
+    else:
+        counts = np.zeros(0, dtype=np.int64)
+
+    if len(change_positions) == 0 or change_positions[0] > 0:
+        change_positions = np.append(0, change_positions)
+        counts = np.append(0, counts)
+
+    return np.diff(np.append(change_positions, length)), change_positions, counts
+
+
+def read_manifest(index_dir):
+    manifest_file_name = os.path.join(index_dir, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_file_name):
+        return {'entries': []}
+    with open(manifest_file_name, 'r') as mf:
+        return json.load(mf)
+
+
+def write_manifest(index_dir, manifest):
+    with open(os.path.join(index_dir, MANIFEST_FILE_NAME), 'w') as mf:
+        json.dump(manifest, mf, indent=2)
+
+
+def load_indices(directory, state_shapes, fingerprints, kind=BITS):
+    """ memory-maps all activation indices of one kind of a project
+
+    :param directory: project directory
+    :param state_shapes: dict source -> shape of the state matrix, used to skip stale indices
+    :param fingerprints: dict source -> mtime and size of its state file, used to skip stale indices
+    :param kind: BITS or INTERVALS
+    :return: dict index_key -> memory-mapped packed matrix (BITS) or tuple (starts, ends, offsets) (INTERVALS)
+    :rtype: dict
+    """
+    index_dir = os.path.join(directory, INDEX_DIR_NAME)
+    res = {}
+    if not os.path.isdir(index_dir):
+        return res
+
+    for entry in read_manifest(index_dir)['entries']:
+        source = entry['source']
+        if entry.get('kind', BITS) != kind or source not in state_shapes:
+            continue
+        if kind == BITS:
+            file_names = [os.path.join(index_dir, entry['file'])]
+        else:
+            file_names = [os.path.join(index_dir, x) for x in interval_file_names(entry['file'])]
+        if not all(os.path.isfile(x) for x in file_names):
+            continue
+        if [entry['length'], entry['cells']] != list(state_shapes[source]):
+            logging.warning('activation index %s does not match states shape -- ignored', entry['file'])
+            continue
+        if entry.get('fingerprint') != list(fingerprints[source]):
+            logging.warning('activation index %s is outdated -- rebuild it with tools/create_activation_index.py',
+                            entry['file'])
+            continue
+
+        arrays = tuple(np.load(x, mmap_mode='r') for x in file_names)
+        res[index_key(source, entry['transform'], entry['threshold'])] = arrays[0] if kind == BITS else arrays
+
+    return res
+
+
+def _cell_masks(cells):
+    """ byte columns and bit masks selecting cells in a packed row
+
+    :return: (byte columns, masks per byte column)
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    columns, inverse = np.unique(cells // 8, return_inverse=True)
+    masks = np.zeros(len(columns), dtype=np.uint8)
+    np.bitwise_or.at(masks, inverse, (128 >> (cells % 8)).astype(np.uint8))
+    return columns, masks
+
+
+def count_active(packed, cells, start=0, end=None):
+    """ number of active cells (out of cells) for each time step in [start, end)
+
+    :param packed: bit-packed activation index
+    :param cells: list of cell indices
+    :param start: first time step
+    :param end: last time step (exclusive), None for all
+    :return: active cell count per time step
+    :rtype: np.ndarray
+    """
+    end = len(packed) if end is None else min(end, len(packed))
+    columns, masks = _cell_masks(cells)
+    res = np.zeros(max(end - start, 0), dtype=np.int64)
+    slice_offset = start
+    while slice_offset < end:
+        slice_end = min(slice_offset + MAX_ROWS * 10, end)
+        selected = packed[slice_offset:slice_end, columns] & masks
+        res[slice_offset - start:slice_end - start] = POPCOUNT[selected].sum(axis=1)
+        slice_offset = slice_end
+
+    return res
+
+
+def active_rows(packed, start, end, n_cells):
+    """ expands a row range of the index into a boolean activation matrix
+
+    :param packed: bit-packed activation index
+    :param start: first time step
+    :param end: last time step (exclusive)
+    :param n_cells: number of cells in the original state matrix
+    :return: boolean matrix (end-start) x n_cells
+    """
+    return np.unpackbits(packed[start:end], axis=1, count=n_cells).astype(bool)
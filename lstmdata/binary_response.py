@@ -0,0 +1,77 @@
+import json
+import struct
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+MIME_TYPE = 'application/x-lstmvis-binary'
+MAGIC = b'LSTV'
+FLOAT_TYPES = {'float16': '<f2', 'float32': '<f4'}
+INT_TYPE = ('int32', '<i4')
+BUFFER_KEY = '__buffer__'
+ALIGNMENT = 8
+
+
+def accepted_dtype(accept_header):
+    """ checks if the client accepts the binary format
+
+    ``Accept: application/x-lstmvis-binary; dtype=float16`` requests float16 buffers,
+    without ``dtype`` float32 buffers are used.
+
+    :param accept_header: value of the HTTP Accept header
+    :return: float dtype name ('float16', 'float32') or None if binary is not accepted
+    """
+    for media_range in (accept_header or '').split(','):
+        parts = [x.strip() for x in media_range.split(';')]
+        if parts[0] != MIME_TYPE:
+            continue
+        params = dict(p.split('=', 1) for p in parts[1:] if '=' in p)
+        dtype = params.get('dtype', 'float32')
+        return dtype if dtype in FLOAT_TYPES else 'float32'
+
+    return None
+
+
+def encode(payload, dtype='float32'):
+    """ encodes a payload that contains np.arrays into the binary format:
+
+    ``'LSTV' | uint32 (LE) header length | JSON header | padding | raw buffers``
+
+    The header is ``{"payload": ..., "buffers": [{"offset", "dtype", "shape"}, ...]}``.
+    Each np.array in the payload is replaced by ``{"__buffer__": <index into buffers>}``,
+    offsets are relative to the first buffer and aligned to 8 bytes.
+    Float arrays are stored with dtype, integer arrays as int32.
+
+    :param payload: JSON-serializable structure with np.arrays
+    :param dtype: 'float16' or 'float32'
+    :return: encoded message
+    :rtype: bytes
+    """
+    buffers = []
+    buffer_infos = []
+    offset = [0]
+
+    def pack(x):
+        if isinstance(x, np.ndarray):
+            if np.issubdtype(x.dtype, np.integer) or x.dtype == np.bool_:
+                type_name, np_type = INT_TYPE
+            else:
+                type_name, np_type = dtype, FLOAT_TYPES[dtype]
+            data = np.ascontiguousarray(x, dtype=np_type).tobytes()
+            buffer_infos.append({'offset': offset[0], 'dtype': type_name, 'shape': list(x.shape)})
+            buffers.append(data + b'\0' * (-len(data) % ALIGNMENT))
+            offset[0] += len(buffers[-1])
+            return {BUFFER_KEY: len(buffers) - 1}
+        elif isinstance(x, dict):
+            return {k: pack(v) for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return [pack(v) for v in x]
+        elif isinstance(x, np.generic):
+            return x.item()
+        return x
+
+    header = json.dumps({'payload': pack(payload), 'buffers': buffer_infos}).encode('utf-8')
+    padding = b'\0' * (-len(header) % ALIGNMENT)
+
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header, padding] + buffers)
@@ -0,0 +1,174 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+MB = 1024 * 1024
+CHUNK_BYTES = 4 * MB  # target size of a cached row block
+
+
+class ChunkCache:
+    def __init__(self, max_bytes=1024 * MB):
+        """LRU cache for row blocks of state matrices with a global byte budget
+        and optional byte budgets per owner (project).
+
+        :param max_bytes: global byte budget (0 disables caching)
+        :rtype: None
+        """
+        self.max_bytes = max_bytes
+        self.budgets = {}
+        self.entries = OrderedDict()  # key -> (owner, array)
+        self.bytes = 0
+        self.owner_bytes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def set_budget(self, owner, max_bytes):
+        """ limits the bytes used by entries of one owner
+
+        :param owner: owner id (e.g. project name)
+        :param max_bytes: byte budget, None for the global budget only
+        """
+        with self._lock:
+            if max_bytes is None:
+                self.budgets.pop(owner, None)
+            else:
+                self.budgets[owner] = max_bytes
+                self._evict(owner)
+
+    def budget(self, owner):
+        return min(self.max_bytes, self.budgets.get(owner, self.max_bytes))
+
+    def get(self, owner, key, loader):
+        """ cached entry for key or -- if missing -- the result of loader()
+
+        :param owner: owner id (e.g. project name)
+        :param key: hashable entry key
+        :param loader: function without parameters that returns the np.array for key
+        :return: the (read-only) array
+        """
+        key = (owner, key)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][1]
+            self.misses += 1
+
+        value = loader()
+        value.flags.writeable = False
+        if value.nbytes > self.budget(owner):
+            return value
+
+        with self._lock:
+            if key not in self.entries:
+                self.entries[key] = (owner, value)
+                self.bytes += value.nbytes
+                self.owner_bytes[owner] = self.owner_bytes.get(owner, 0) + value.nbytes
+                self._evict(owner)
+
+        return value
+
+    def _evict(self, owner):
+        """ drops least recently used entries until owner and global budgets are met -- needs lock """
+        if self.owner_bytes.get(owner, 0) > self.budget(owner):
+            for key in [k for k, v in self.entries.items() if v[0] == owner]:
+                if self.owner_bytes[owner] <= self.budget(owner):
+                    break
+                self._drop(key)
+
+        while self.bytes > self.max_bytes and self.entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        owner, value = self.entries.pop(key)
+        self.bytes -= value.nbytes
+        self.owner_bytes[owner] -= value.nbytes
+        self.evictions += 1
+
+    def clear(self, owner=None):
+        with self._lock:
+            for key in [k for k, v in self.entries.items() if owner is None or v[0] == owner]:
+                owner_key, value = self.entries.pop(key)
+                self.bytes -= value.nbytes
+                self.owner_bytes[owner_key] -= value.nbytes
+
+    def stats(self):
+        """ counters and memory usage
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'owners': {o: {'bytes': b, 'max_bytes': self.budget(o)} for o, b in self.owner_bytes.items()}
+            }
+
+
+shared_cache = ChunkCache()
+
+
+class CachedMatrix:
+    def __init__(self, cache, owner, source, data):
+        """read access to a (HDF5) state matrix through row blocks in a ChunkCache
+
+        Supports the slicing used in LSTMDataHandler: ``m[a:b]``, ``m[a:b, cols]`` and ``m[a:b, :]``.
+
+        :param cache: the ChunkCache
+        :param owner: owner id for the cache budget
+        :param source: source id in the format file::path
+        :param data: the underlying matrix (time steps x cells)
+        :rtype: None
+        """
+        self.cache = cache
+        self.owner = owner
+        self.source = source
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        row_bytes = max(1, int(np.prod(self.shape[1:])) * self.dtype.itemsize)
+        # small budgets get smaller blocks
+        self.chunk_rows = max(1, min(CHUNK_BYTES, cache.budget(owner) // 64) // row_bytes)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, c):
+        start = c * self.chunk_rows
+        return self.cache.get(self.owner, (self.source, c),
+                              lambda: np.asarray(self.data[start:min(start + self.chunk_rows, self.shape[0])]))
+
+    def __getitem__(self, item):
+        rows, columns = (item[0], item[1:]) if isinstance(item, tuple) else (item, ())
+        if not isinstance(rows, slice) or rows.step not in (None, 1):
+            return self.data[item]
+
+        start, stop, _ = rows.indices(self.shape[0])
+        stop = max(start, stop)
+        first_chunk = start // self.chunk_rows
+        last_chunk = (stop - 1) // self.chunk_rows if stop > start else first_chunk
+
+        # large scans would only flush the cache -- read them directly
+        chunk_bytes = self.chunk_rows * self.dtype.itemsize * int(np.prod(self.shape[1:]))
+        if (last_chunk - first_chunk + 1) * chunk_bytes * 2 > self.cache.budget(self.owner):
+            return self.data[item]
+
+        blocks = [self._chunk(c) for c in range(first_chunk, last_chunk + 1)]
+        offset = first_chunk * self.chunk_rows
+        if len(blocks) == 1:
+            res = blocks[0][start - offset:stop - offset]
+        else:
+            res = np.concatenate(blocks)[start - offset:stop - offset]
+
+        if columns:
+            res = res[(slice(None),) + tuple(columns)]
+        return np.array(res)
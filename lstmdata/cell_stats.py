@@ -0,0 +1,223 @@
+import logging
+import os
+
+import numpy as np
+
+import lstmdata.activation_index as ai
+
+__author__ = 'Hendrik Strobelt'
+
+STATS_DIR_NAME = 'cell_stats'
+THRESHOLDS = (.1, .2, .3, .4, .5, .6, .7, .8, .9)  # activation thresholds (after transform)
+QUANTILE_LEVELS = (.01, .05, .25, .5, .75, .95, .99)
+BINS = 1024  # histogram bins on the tanh scale -- resolution of the approximate quantiles
+CHUNK_ELEMENTS = int(4e6)  # elements of a state matrix processed at once
+
+
+def stats_file_name(source):
+    """ file name for the statistics of a source inside STATS_DIR_NAME
+
+    :param source: source id in the format file::path
+    :rtype: str
+    """
+    return source.replace('::', '__').replace('/', '.') + '.npz'
+
+
+def cutoffs(thresholds):
+    """ thresholds on stored values -- a value x is active for threshold t if not x < cutoff
+
+    Matching compares the stored values of all sources (whatever their transform) against
+    arctanh(t), see activation_index.corrected_threshold.
+    """
+    return ai.corrected_threshold(np.asarray(thresholds, dtype=np.float64))
+
+
+def histogram_quantiles(histogram, levels, v_min, v_max):
+    """ approximate quantiles from histograms on the tanh scale (see BINS)
+
+    :param histogram: histograms (... x BINS)
+    :param levels: quantile levels
+    :param v_min: minimal values (quantiles are clipped to [v_min, v_max])
+    :param v_max: maximal values
+    :return: np.array (levels x ...)
+    """
+    cumulative = np.cumsum(histogram, axis=-1)
+    total = cumulative[..., -1:]
+    res = []
+    for level in levels:
+        bin_index = (cumulative < np.maximum(level * total, 1)).sum(axis=-1)
+        center = (np.minimum(bin_index, BINS - 1) + .5) * (2. / BINS) - 1
+        res.append(np.clip(np.arctanh(center), v_min, v_max))
+    return np.array(res)
+
+
+class Accumulator:
+    def __init__(self, n_cells, limits):
+        """per-cell statistics of consecutive rows of a state matrix -- updated chunk by chunk,
+        accumulators of neighboring row ranges can be merged
+
+        :param n_cells: number of cells
+        :param limits: activation cutoffs on stored values (see cutoffs)
+        :rtype: None
+        """
+        n_limits = len(limits)
+        self.limits = np.asarray(limits, dtype=np.float64)
+        self.count = 0
+        self.mean = np.zeros(n_cells)
+        self.m2 = np.zeros(n_cells)  # sum of squared differences from the mean
+        self.min = np.full(n_cells, np.inf)
+        self.max = np.full(n_cells, -np.inf)
+        self.histogram = np.zeros((n_cells, BINS), dtype=np.int64)
+        self.active = np.zeros((n_limits, n_cells), dtype=np.int64)
+        self.runs = np.zeros((n_limits, n_cells), dtype=np.int64)
+        self.first_active = np.zeros((n_limits, n_cells), dtype=bool)
+        self.last_active = np.zeros((n_limits, n_cells), dtype=bool)
+
+    def update(self, values):
+        """ adds the next rows
+
+        :param values: np.array (rows x cells)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+        chunk = Accumulator(values.shape[1], self.limits)
+        chunk.count = n
+        chunk.mean = values.mean(axis=0)
+        chunk.m2 = ((values - chunk.mean) ** 2).sum(axis=0)
+        chunk.min = values.min(axis=0)
+        chunk.max = values.max(axis=0)
+
+        bins = np.clip(((np.tanh(values) + 1) * (BINS / 2)).astype(np.int64), 0, BINS - 1)
+        bins += np.arange(values.shape[1]) * BINS
+        chunk.histogram = np.bincount(bins.reshape(-1), minlength=chunk.histogram.size).reshape(chunk.histogram.shape)
+
+        for k, limit in enumerate(self.limits):
+            active = ~(values < limit)
+            chunk.active[k] = active.sum(axis=0)
+            chunk.runs[k] = active[0] + (active[1:] & ~active[:-1]).sum(axis=0)
+            chunk.first_active[k] = active[0]
+            chunk.last_active[k] = active[-1]
+        self.merge(chunk)
+
+    def merge(self, other):
+        """ appends the statistics of the rows that follow this accumulator's rows
+
+        :param other: Accumulator
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.histogram = self.histogram + other.histogram
+        self.active = self.active + other.active
+        # a run that crosses the border was counted twice
+        self.runs = self.runs + other.runs - (self.last_active & other.first_active)
+        self.last_active = other.last_active
+        self.count = count
+
+    def result(self, thresholds, transform, fingerprint=None):
+        """ the statistics as flat dict of arrays (the content of a stats file)
+
+        :param thresholds: activation thresholds the cutoffs were derived from
+        :param transform: transform of the source
+        :param fingerprint: mtime and size of the state file
+        :rtype: dict
+        """
+        count = max(self.count, 1)
+        all_active = self.active.sum(axis=1)
+        return {
+            'count': np.array(self.count),
+            'transform': np.array(transform),
+            'fingerprint': np.array(fingerprint if fingerprint is not None else [], dtype=np.float64),
+            'thresholds': np.asarray(thresholds, dtype=np.float64),
+            'quantile_levels': np.array(QUANTILE_LEVELS),
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'std': np.sqrt(self.m2 / count),
+            'quantiles': histogram_quantiles(self.histogram, QUANTILE_LEVELS, self.min, self.max),
+            'active_frequency': self.active / count,
+            'mean_run_length': self.active / np.maximum(self.runs, 1),
+            'global_min': self.min.min(),
+            'global_max': self.max.max(),
+            'global_mean': self.mean.mean(),
+            'global_std': np.sqrt((self.m2.sum() + (count * (self.mean - self.mean.mean()) ** 2).sum())
+                                  / (count * len(self.mean))),
+            'global_quantiles': histogram_quantiles(self.histogram.sum(axis=0), QUANTILE_LEVELS,
+                                                self.min.min(), self.max.max()),
+            'global_active_frequency': all_active / (count * len(self.mean)),
+            'global_mean_run_length': all_active / np.maximum(self.runs.sum(axis=1), 1)
+        }
+
+
+def accumulate(data, start, end, limits):
+    """ statistics of the rows [start, end) of a state matrix -- read chunk by chunk
+
+    :param data: state matrix (HDF5 dataset, np.memmap, UnsignedView ...)
+    :param limits: activation cutoffs on stored values (see cutoffs)
+    :rtype: Accumulator
+    """
+    res = Accumulator(data.shape[1], limits)
+    chunk_rows = max(1, CHUNK_ELEMENTS // max(1, data.shape[1]))
+    for slice_offset in range(start, end, chunk_rows):
+        res.update(data[slice_offset:min(end, slice_offset + chunk_rows)])
+    return res
+
+
+def write_stats(file_name, stats):
+    tmp_file = '{}.{}.tmp.npz'.format(file_name, os.getpid())
+    np.savez(tmp_file, **stats)
+    os.replace(tmp_file, file_name)
+
+
+def to_json(stats):
+    """ stats file content as JSON-serializable dict
+
+    :param stats: dict of arrays (see Accumulator.result)
+    :rtype: dict
+    """
+    res = {'cells': {}, 'global': {}}
+    for key, value in stats.items():
+        if key == 'fingerprint':
+            continue
+        value = value.tolist()
+        if key.startswith('global_'):
+            res['global'][key[len('global_'):]] = value
+        elif key in ('min', 'max', 'mean', 'std', 'quantiles', 'active_frequency', 'mean_run_length'):
+            res['cells'][key] = value
+        else:
+            res[key] = value
+    return res
+
+
+def load_stats(directory, sources, fingerprints):
+    """ loads the statistics files of sources (see tools/h5_table_stats.py)
+
+    :param directory: project directory
+    :param sources: list of source ids (file::path)
+    :param fingerprints: dict source -> mtime and size of its state file (outdated stats are skipped)
+    :return: dict source -> dict of arrays
+    :rtype: dict
+    """
+    stats_dir = os.path.join(directory, STATS_DIR_NAME)
+    res = {}
+    for source in sources:
+        file_name = os.path.join(stats_dir, stats_file_name(source))
+        if not os.path.isfile(file_name):
+            continue
+        with np.load(file_name) as stats_file:
+            stats = {k: stats_file[k] for k in stats_file.files}
+        if not np.array_equal(stats['fingerprint'], fingerprints[source]):
+            logging.warning('statistics of %s are outdated -- rebuild them with tools/h5_table_stats.py', source)
+            continue
+        res[source] = stats
+    return res
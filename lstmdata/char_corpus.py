@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+CORPUS_DIR_NAME = 'search_corpus'
+MANIFEST_FILE_NAME = 'manifest.json'
+CORPUS_FILE_NAME = 'corpus.npy'
+SUFFIX_ARRAY_FILE_NAME = 'suffix_array.npy'
+MAX_ROWS = 1000000
+MAX_CANDIDATES = 100000  # more suffix array candidates for a regex prefix -> scan the whole corpus instead
+META_CHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+def project_chars(word_ids, id2word):
+    """ the character corpus: first character of each token
+
+    :param word_ids: word sequence (HDF5 dataset or np.array)
+    :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+    :return: code points (uint8 if all are < 256, uint32 otherwise)
+    """
+    table = np.fromiter((ord(word[0]) if word else 0 for word in id2word.words.tolist()), dtype=np.uint32,
+                        count=len(id2word.words))
+    table = table if len(table) else np.zeros(1, dtype=np.uint32)
+    dtype = np.uint8 if table.max() < 256 else np.uint32
+
+    codes = np.empty(len(word_ids), dtype=dtype)
+    for slice_offset in range(0, len(word_ids), MAX_ROWS):
+        codes[slice_offset:slice_offset + MAX_ROWS] = table[word_ids[slice_offset:slice_offset + MAX_ROWS]]
+    return codes
+
+
+def suffix_array(codes):
+    """ suffix array by prefix doubling -- O(n log^2 n), vectorized
+
+    :param codes: np.array of symbols
+    :return: start positions of all suffixes in lexicographic order (shorter suffixes first on ties)
+    """
+    n = len(codes)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    rank = np.unique(codes, return_inverse=True)[1].astype(np.int64).reshape(-1)
+    k = 1
+    while True:
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        sa = np.lexsort((second, rank))
+        new_group = np.ones(n, dtype=np.int64)
+        new_group[1:] = (rank[sa][1:] != rank[sa][:-1]) | (second[sa][1:] != second[sa][:-1])
+        rank[sa] = np.cumsum(new_group) - 1
+        if rank[sa[-1]] == n - 1 or k >= n:
+            return sa
+        k *= 2
+
+
+def literal_prefix(query):
+    """ the literal characters a regex match has to start with
+
+    :param query: regular expression
+    :return: tuple (literal prefix, query is a plain literal)
+    """
+    if '|' in query:
+        return '', False
+    for i, c in enumerate(query):
+        if c in META_CHARACTERS:
+            # a quantifier applies to the character before it
+            return (query[:i - 1] if c in '*?{' else query[:i]), False
+    return query, True
+
+
+class CharCorpus:
+    def __init__(self, codes, sa):
+        """character corpus of a project (one character per token) with suffix array
+
+        :param codes: code points, e.g. np.memmap
+        :param sa: suffix array of codes (None: all queries scan the corpus)
+        :rtype: None
+        """
+        self.codes = codes
+        self.sa = sa
+        self._text = None
+
+    @property
+    def text(self):
+        """ the corpus as searchable buffer -- latin-1 corpora (uint8) are searched directly on their
+        (memory-mapped) bytes, other corpora are decoded into a string on first use """
+        if self._text is None:
+            if self.codes.dtype == np.uint8:
+                self._text = memoryview(self.codes) if len(self.codes) else b''
+            else:
+                self._text = np.asarray(self.codes, dtype='<u4').tobytes().decode('utf-32-le')
+        return self._text
+
+    def compile(self, query):
+        """ query as pattern for text -- a bytes pattern for latin-1 corpora
+
+        :param query: regular expression
+        :return: compiled pattern (None if the query has characters that are not in the corpus)
+        """
+        if self.codes.dtype != np.uint8:
+            return re.compile(query)
+        try:
+            return re.compile(query.encode('latin-1'))
+        except UnicodeEncodeError:
+            return None
+
+    def _suffix_range(self, literal):
+        """ range in the suffix array of all suffixes that start with literal """
+        key = [ord(c) for c in literal]
+        m = len(key)
+
+        def bound(strict):
+            lo, hi = 0, len(self.sa)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                s = int(self.sa[mid])
+                prefix = self.codes[s:s + m].tolist()
+                if prefix < key or (strict and prefix == key):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        return bound(False), bound(True)
+
+    def search(self, query, no_results=20):
+        """ non-overlapping matches of a regular expression in order of position (as re.finditer)
+
+        Literal queries are answered from the suffix array, queries with a literal prefix
+        verify the suffix array candidates, all others scan the corpus once.
+
+        :param query: regular expression
+        :param no_results: maximal number of results
+        :return: list of (start, end)
+        """
+        pattern = self.compile(query)
+        if pattern is None:
+            return []
+        prefix, is_literal = literal_prefix(query)
+        if prefix and self.sa is not None:
+            lo, hi = self._suffix_range(prefix)
+            if is_literal or hi - lo <= MAX_CANDIDATES:
+                res = []
+                last_end = 0
+                for pos in np.sort(self.sa[lo:hi]).tolist():
+                    if len(res) >= no_results:
+                        break
+                    if pos < last_end:
+                        continue
+                    m = None if is_literal else pattern.match(self.text, pos)
+                    end = pos + len(prefix) if is_literal else (m.end() if m else -1)
+                    if end >= 0:
+                        res.append((pos, end))
+                        last_end = max(end, pos + 1)
+                return res
+
+        res = []
+        for m in pattern.finditer(self.text):
+            if len(res) >= no_results:
+                break
+            res.append(m.span())
+        return res
+
+
+def _fingerprint(file_names):
+    return [[os.path.getmtime(f), os.path.getsize(f)] for f in file_names]
+
+
+def build(directory, word_ids, id2word, source_files):
+    """ builds the character corpus and suffix array of a project (see tools/create_search_corpus.py)
+
+    :param directory: project directory
+    :param word_ids: word sequence (HDF5 dataset or np.array)
+    :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+    :param source_files: files the corpus is derived from (word sequence and dictionary)
+    :return: number of characters
+    """
+    corpus_dir = os.path.join(directory, CORPUS_DIR_NAME)
+    codes = project_chars(word_ids, id2word)
+    sa = suffix_array(codes)
+    sa = sa.astype(np.int32) if len(sa) < 2 ** 31 else sa
+    if not os.path.exists(corpus_dir):
+        os.mkdir(corpus_dir)
+    np.save(os.path.join(corpus_dir, CORPUS_FILE_NAME), codes)
+    np.save(os.path.join(corpus_dir, SUFFIX_ARRAY_FILE_NAME), sa)
+    with open(os.path.join(corpus_dir, MANIFEST_FILE_NAME), 'w') as mf:
+        json.dump({'fingerprint': _fingerprint(source_files), 'length': len(codes)}, mf)
+    return len(codes)
+
+
+def load(directory, word_ids, id2word, source_files):
+    """ memory-maps the character corpus and suffix array of a project -- if they are missing or outdated,
+    the corpus is derived from the word sequence and all queries scan it (no suffix array is built)
+
+    :param directory: project directory
+    :param word_ids: word sequence (HDF5 dataset or np.array)
+    :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+    :param source_files: files the corpus is derived from (word sequence and dictionary)
+    :rtype: CharCorpus
+    """
+    corpus_dir = os.path.join(directory, CORPUS_DIR_NAME)
+    manifest_file_name = os.path.join(corpus_dir, MANIFEST_FILE_NAME)
+    if os.path.isfile(manifest_file_name):
+        with open(manifest_file_name, 'r') as mf:
+            if json.load(mf).get('fingerprint') == _fingerprint(source_files):
+                return CharCorpus(np.load(os.path.join(corpus_dir, CORPUS_FILE_NAME), mmap_mode='r'),
+                                  np.load(os.path.join(corpus_dir, SUFFIX_ARRAY_FILE_NAME), mmap_mode='r'))
+
+    logging.warning('character corpus of %s is missing or outdated -- regex search scans the corpus. '
+                    'Build it with tools/create_search_corpus.py', directory)
+    return CharCorpus(project_chars(word_ids, id2word), None)
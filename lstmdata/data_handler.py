@@ -1,74 +1,109 @@
-import cgi
+import html
 
 import os
+import threading
 
 import h5py
-import resource
 
 import numpy as np
 import re
 
+import lstmdata.activation_index as ai
+import lstmdata.cache as ch
+import lstmdata.cell_stats as cs
+import lstmdata.char_corpus as cc
+import lstmdata.dictionary as wd
 import lstmdata.helper_functions as hf
+import lstmdata.raw_states as rs
+import lstmdata.result_cache as rc
+import lstmdata.sharded as sharded
+import lstmdata.token_index as ti
+import lstmdata.unsigned as us
 
 __author__ = 'Hendrik Strobelt'
 
+SCORE_BLOCK_SIZE = int(2e7)  # elements of state matrices evaluated at once while scoring match candidates
+META_TABLE_BYTES = 16 * ch.MB  # meta tables up to this size are kept in memory
+
 
 class LSTMDataHandler:
-    def __init__(self, directory, config):
+    def __init__(self, directory, config, cache=None, results=None):
         """LSTM data handler
 
         :param directory: base directory for lstm project
         :param config: configuration (YAML file content)
+        :param cache: ChunkCache for state row blocks (default: lstmdata.cache.shared_cache)
+        :param results: ResultCache for match queries (default: lstmdata.result_cache.shared_results)
         :rtype: None
         """
         self.config = config
+        self.directory = directory
 
         # storage for h5 references and all dicts
         self.h5_files = {}
-        self.dicts_value_id = {}
-        self.dicts_id_value = {}
+        self.dicts = {}
 
         # open all h5 files
         h5files = {k: v for k, v in config['files'].items() if (v.endswith('.h5') or v.endswith('.hdf5'))}
         for key, file_name in h5files.items():
             self.h5_files[key] = h5py.File(os.path.join(directory, file_name), 'r')
 
-        # load all dict files of format: value<space>id
+        # load all dict files of format: value<space>id -- as arrays indexed by id, cached in binary form
         dict_files = {k: v for k, v in config['files'].items() if (v.endswith('.dict') or v.endswith('.txt'))}
         for name, file_name in dict_files.items():
-            kv = {}
-            vk = {}
-            with open(os.path.join(directory, file_name), 'r') as f:
-                for line in f:
-                    if len(line) > 0:
-                        if len(line.split()) == 2:
-                            k, v = line.split()
-                            kv[k] = int(v)
-                            vk[int(v)] = k
-                        elif line[0] == " ":
-                            k = " "
-                            v = line.strip()
-                            kv[k] = int(v)
-                            vk[int(v)] = k
-                self.dicts_value_id[name] = kv
-                self.dicts_id_value[name] = vk
-
-        # for caching the matrices
-        self.cached_matrix = {}
-        self.current = {}
+            self.dicts[name] = wd.load(os.path.join(directory, file_name))
+
+        # row blocks of state matrices are cached in a byte-budgeted LRU cache
+        self.cache = cache if cache is not None else ch.shared_cache
+        self.cache_owner = os.path.basename(os.path.abspath(directory))
+        self.cached_matrices = {}
+        if self.config.get('etc') and 'cache_mb' in self.config['etc']:
+            self.cache.set_budget(self.cache_owner, int(self.config['etc']['cache_mb'] * ch.MB))
+        self.results = results if results is not None else rc.shared_results
+        self._char_corpus = None
+        self._char_corpus_lock = threading.Lock()
+        self.meta_tables = {}  # in-memory copies of small meta tables
 
-        # enrich config with sizes
         default_state_file = self.config['states']['file']
+        default_backend = self.config['states'].get('backend', 'hdf5')
+        self.unsigned_views = {}  # source -> signed source it is derived from
         for x in self.config['states']['types']:
             x['file'] = x.get('file', default_state_file)
             x['unsigned'] = x.get('unsigned', False)
             x['transform'] = x.get('transform', 'tanh')
+            x['backend'] = x.get('backend', default_backend)
+            if 'signed_path' in x:
+                x['unsigned'] = True
+                self.unsigned_views[x['file'] + '::' + x['path']] = x['file'] + '::' + x['signed_path']
+
+        # memory-map raw copies of states with backend 'mmap' (see tools/states_to_raw.py)
+        self.raw_states = rs.load_states(directory, [self.stored_source(x['file'] + '::' + x['path'])
+                                                     for x in self.config['states']['types']
+                                                     if x['backend'] == 'mmap'])
+
+        # enrich config with sizes
+        for x in self.config['states']['types']:
             cell_states, _ = self.get_cached_matrix(x['transform'], x['file'] + '::' + x['path'])
             x['size'] = list(cell_states.shape)
 
+        # mtime and size of the state files -- indices and statistics of older files are skipped
+        state_files = {x['file'] + '::' + x['path']: self.h5_files[x['file']].filename
+                       for x in self.config['states']['types']}
+        state_fingerprints = {k: [os.path.getmtime(v), os.path.getsize(v)] for k, v in state_files.items()}
+
+        # memory-map bit-packed activation indices and interval indices (see tools/create_activation_index.py)
+        state_shapes = {x['file'] + '::' + x['path']: x['size'] for x in self.config['states']['types']}
+        self.activation_indices = ai.load_indices(directory, state_shapes, state_fingerprints, ai.BITS)
+        self.interval_indices = ai.load_indices(directory, state_shapes, state_fingerprints, ai.INTERVALS)
+
+        # per-cell statistics (see tools/h5_table_stats.py)
+        self.cell_stats = cs.load_stats(directory, list(state_files.keys()), state_fingerprints)
+        for x in self.config['states']['types']:
+            x['stats'] = x['file'] + '::' + x['path'] in self.cell_stats
+
         ws = self.config['word_sequence']
         self.config['word_sequence']['size'] = list(self.h5_files[ws['file']][ws['path']].shape)
-        self.config['word_sequence']['dict_size'] = len(self.dicts_id_value[ws['dict_file']])
+        self.config['word_sequence']['dict_size'] = len(self.dicts[ws['dict_file']])
 
         if 'word_embedding' in self.config:
             we = self.config['word_embedding']
@@ -76,11 +111,15 @@ class LSTMDataHandler:
         else:
             self.config['word_embedding'] = {'size': [-1, -1]}
 
-        # enrich meta section with proper ranges
-        self.config['index'] = os.path.isdir(os.path.join(directory, 'indexdir'))
-        if self.config['index']:
+        # search index: memory-mapped token index (see tools/create_index.py) or Whoosh index as fallback
+        self.token_index = ti.load(directory, self.dicts[ws['dict_file']])
+        has_whoosh_index = os.path.isdir(os.path.join(directory, 'indexdir'))
+        self.config['index'] = self.token_index is not None or has_whoosh_index
+        if has_whoosh_index:
             self.config['index_dir'] = os.path.join(directory, 'indexdir')
 
+        # enrich meta section with proper ranges
+
         if self.config.get('meta', False):
             for _, m_info in self.config['meta'].items():
                 m_info['type'] = m_info.get('type', 'general')
@@ -88,7 +127,7 @@ class LSTMDataHandler:
                 m_info['vis']['range'] = m_info['vis'].get('range', '0...100')
                 vis_range = m_info['vis']['range']
                 if vis_range == 'dict':
-                    m_info['vis']['range'] = self.dicts_value_id[m_info['dict']].keys()
+                    m_info['vis']['range'] = self.dicts[m_info['dict']].values()
                 elif type(vis_range) is str:
                     m = re.search("([0-9]+)\.\.\.([0-9]+)", vis_range)
                     if m:
@@ -131,16 +170,15 @@ class LSTMDataHandler:
         cell_states, data_transformed = self.get_cached_matrix(data_transform, source)
         # cell_states = self.h5_files[self.config['states']['file']][source]
 
+        # read all windows with one read per merged span
+        windows = hf.window_bounds(pos_array, left, right, len(cell_states))
+        window_states = hf.read_windows(cell_states, windows,
+                                        columns=cell_selection if len(cell_selection) > 0 else None)
+
         res = []
         sum_active = []
-        for pos in pos_array:
-            left_pos = pos - min(left, pos)
-            right_pos = min(len(cell_states), pos + 1 + right)
-
-            if len(cell_selection) == 0:
-                cs = cell_states[left_pos:right_pos]
-            else:
-                cs = cell_states[left_pos:right_pos, cell_selection]
+        for pos, (left_pos, right_pos), cs in zip(pos_array, windows, window_states):
+            cs = np.array(cs)  # windows might overlap -- don't modify the shared span
 
             if not data_transformed:
                 if data_transform == 'tanh':
@@ -184,10 +222,10 @@ class LSTMDataHandler:
                 activation_threshold_corrected = activation_threshold
                 # already tanh applied if necessary
 
-                a = cs
+                a = np.array(cs) if raw else cs  # raw results might share memory with cs
                 hf.threshold_discrete(a, activation_threshold_corrected, 0, 1)
 
-                sum_active.append(np.sum(a, axis=1).tolist())
+                sum_active.append(np.sum(a, axis=1, dtype=np.int32) if raw else np.sum(a, axis=1).tolist())
 
             del cs
             res.append(sub_res)
@@ -203,18 +241,16 @@ class LSTMDataHandler:
             we = self.config['word_embedding']
             embeddings = self.h5_files[we['file']][we['path']]
 
-        res = []
-        cluster = []
-        for pos in pos_array:
-            left_pos = pos - min(left, pos)
-            right_pos = min(len(word_sequence), pos + 1 + right)
-
-            word_ids = word_sequence[left_pos:right_pos]
+        windows = hf.window_bounds(pos_array, left, right, len(word_sequence))
+        window_word_ids = hf.read_windows(word_sequence, windows)
+        if add_embeddings and has_embedding:
+            window_embeddings = hf.read_windows(embeddings, windows)
 
+        res = []
+        for i, (pos, (left_pos, right_pos), word_ids) in enumerate(zip(pos_array, windows, window_word_ids)):
             words = []
             if 'dict_file' in ws:
-                mapper = self.dicts_id_value[ws['dict_file']]
-                words = [mapper[x] for x in word_ids.tolist()]
+                words = self.dicts[ws['dict_file']].lookup(word_ids).tolist()
             sub_res = {
                 'pos': pos,
                 'word_ids': word_ids.tolist(),
@@ -224,7 +260,7 @@ class LSTMDataHandler:
             }
 
             if add_embeddings and has_embedding:
-                emb = embeddings[left_pos:right_pos]
+                emb = window_embeddings[i]
                 sub_res['embeddings'] = emb if raw else [[round(y, round_values) for y in x] for x in emb.tolist()]
 
             res.append(sub_res)
@@ -244,67 +280,73 @@ class LSTMDataHandler:
 
         return []
 
+    def meta_table(self, file_key, path):
+        """ meta table -- small tables (see META_TABLE_BYTES) are read once and kept in memory
+
+        :param file_key: key of the HDF5 file in config['files']
+        :param path: path of the table in the HDF5 file
+        :return: HDF5 dataset or np.array
+        """
+        key = (file_key, path)
+        if key not in self.meta_tables:
+            table = self.h5_files[file_key][path]
+            self.meta_tables[key] = table[()] if table.size * table.dtype.itemsize <= META_TABLE_BYTES else None
+        table = self.meta_tables[key]
+        return table if table is not None else self.h5_files[file_key][path]
+
     def _get_meta_wordvec(self, meta_data_info, pos_array, left, right):
-        word_indices = self.h5_files[meta_data_info['file']][meta_data_info['path']]
+        word_indices = self.meta_table(meta_data_info['file'], meta_data_info['path'])
         max_length = len(word_indices)
 
         has_weights = 'weights_path' in meta_data_info
-        word_weights = self.h5_files[meta_data_info['file']][meta_data_info['weights_path']] \
-            if has_weights else []
-
         has_dict = 'dict' in meta_data_info
-        word_dict = self.dicts_id_value[meta_data_info['dict']] if has_dict else []
 
-        res_indices = []
         res_weights = []
         res_words = []
 
-        for pos in pos_array:
-            left_pos = pos - min(left, pos)
-            right_pos = min(max_length, pos + 1 + right)
-
-            wi = word_indices[left_pos:right_pos].tolist()
-            res_indices.append(wi)
+        windows = hf.window_bounds(pos_array, left, right, max_length)
+        window_indices = hf.read_windows(word_indices, windows)
+        res_indices = [wi.tolist() for wi in window_indices]
 
-            if has_dict:
-                res_words.append([[word_dict[wi] for wi in row] for row in wi])
+        # all windows are mapped at once
+        if has_dict and windows:
+            words = self.dicts[meta_data_info['dict']].lookup(np.concatenate(window_indices))
+            res_words = [w.tolist() for w in hf.split_windows(words, windows)]
 
-            if has_weights:
-                weights = word_weights[left_pos:right_pos].tolist()
-                res_weights.append(weights)
+        if has_weights:
+            word_weights = self.meta_table(meta_data_info['file'], meta_data_info['weights_path'])
+            res_weights = [weights.tolist() for weights in hf.read_windows(word_weights, windows)]
 
         return {'word_ids': res_indices, 'words': res_words, 'weights': res_weights}
 
     def _get_meta_general(self, meta_data_info, pos_array, left, right):
-        meta_data = self.h5_files[meta_data_info['file']][meta_data_info['path']]
+        meta_data = self.meta_table(meta_data_info['file'], meta_data_info['path'])
         meta_index = meta_data_info.get('index')
         if not meta_index:
             meta_index = 'self'
-        res = []
         if meta_index == 'self':  # if meta info is related to global coordinates
-            for pos in pos_array:
-                left_pos = pos - min(left, pos)
-                right_pos = min(len(meta_data), pos + 1 + right)
-
-                res.append(meta_data[left_pos:right_pos].tolist())
+            windows = hf.window_bounds(pos_array, left, right, len(meta_data))
+            res = hf.read_windows(meta_data, windows)
         else:  # if meta info is a based on indices from global coordinates (like word index)
             position_data = self.h5_files[self.config[meta_index]['file']][self.config[meta_index]['path']]
-            for pos in pos_array:
-                left_pos = pos - min(left, pos)
-                right_pos = min(len(position_data), pos + 1 + right)
-                meta_indices = position_data[left_pos:right_pos].tolist()
-                res.append([meta_data[ind].tolist() for ind in meta_indices])
+            windows = hf.window_bounds(pos_array, left, right, len(position_data))
+            if not windows:
+                return []
+            # meta rows for the indices of all windows -- one read, scattered back to the windows
+            meta_indices = np.concatenate(hf.read_windows(position_data, windows))
+            res = hf.split_windows(hf.read_rows(meta_data, meta_indices), windows)
 
         # if there is a dict:
         if 'dict' in meta_data_info:
-            mapper = self.dicts_id_value[meta_data_info['dict']]
-            res = [[mapper[y] for y in x] for x in res]
-        return res
+            mapper = self.dicts[meta_data_info['dict']]
+            res = [mapper.lookup(x) for x in res]
+        return [x.tolist() for x in res]
 
     def get_dimensions(self, pos_array, source, left, right, dimensions, round_values=5, data_transform='tanh',
-                       cells=None, activation_threshold=.3, rle=0):
+                       cells=None, activation_threshold=.3, rle=0, raw=False):
         """ selective information for a sequence
 
+        :param raw: deliver states, cell counts and embeddings as numpy arrays (default: false)
         :param rle: filter length
         :param pos_array: list of positions
         :param source: path in states.h5
@@ -331,11 +373,11 @@ class LSTMDataHandler:
                                                         cell_selection=cells,
                                                         activation_threshold=activation_threshold,
                                                         add_active_cells=('cell_count' in dimensions),
-                                                        transpose=True, rle=rle)
+                                                        transpose=True, rle=rle, raw=raw)
                 if 'cell_count' in dimensions:
                     res['cell_count'] = cell_active
             elif dim == 'words':
-                res[dim] = self.get_words(pos_array, left, right)
+                res[dim] = self.get_words(pos_array, left, right, raw=raw)
             elif dim.startswith('meta_'):
                 res[dim] = self.get_meta(dim[5:], pos_array, left, right)
         return res
@@ -351,16 +393,32 @@ class LSTMDataHandler:
         :param data_transform: applied data transformation (tanh, tanhabs, raw)
         :return: list of (position, variance of no. active cells, length of longest activation of all cells)
         """
+        # identical queries (cell order does not matter) share one result -- also when running concurrently
+        key = (self.cache_owner, source, self.source_version(source), tuple(sorted(int(c) for c in cells)),
+               float(activation_threshold), data_transform, bool(add_histograms), int(phrase_length),
+               query_mode, bool(constrain_left), bool(constrain_right), int(no_of_results))
+        return self.results.get(key, lambda: self._query_similar_activations(
+            cells, source, activation_threshold, data_transform, add_histograms, phrase_length,
+            query_mode, constrain_left, constrain_right, no_of_results))
+
+    def _query_similar_activations(self, cells, source, activation_threshold, data_transform, add_histograms,
+                                   phrase_length, query_mode, constrain_left, constrain_right, no_of_results):
         cell_states, data_transformed = self.get_cached_matrix(data_transform, source)
 
 
-        activation_threshold_corrected = activation_threshold
-        if not data_transformed:
-            activation_threshold_corrected = np.arctanh(activation_threshold)
+        activation_threshold_corrected = ai.corrected_threshold(activation_threshold, data_transformed)
 
         cut_off = 2
 
 
+        # bit-packed index and interval index hold the activations of the stored (not transformed) values
+        activation_index = None
+        interval_index = None
+        if not data_transformed:
+            index_key = ai.index_key(source, data_transform, activation_threshold)
+            activation_index = self.activation_indices.get(index_key)
+            interval_index = self.interval_indices.get(index_key)
+
         if query_mode == "fast":
             num_of_cells_per_sum = 5  # how many cells are evaluated per batch
             maximal_length = int(5e5)  # only consider the first 500,000 time steps
@@ -371,35 +429,48 @@ class LSTMDataHandler:
             num_of_cells_per_sum = 1 if num_of_cells_per_sum == 0 else num_of_cells_per_sum
             num_candidates = 10000
 
-
-        cs_cand = None
-        # start = time.time()
-        no_slices = int(np.ceil(len(cells) * 1. / num_of_cells_per_sum))
-        for c in range(0, no_slices):
-            cell_range = cells[c * num_of_cells_per_sum:min((c + 1) * num_of_cells_per_sum, len(cells))]
-            c_discrete = cell_states[:maximal_length, cell_range]
-            hf.threshold_discrete(c_discrete, activation_threshold_corrected, 0, 1)
-
-            if num_of_cells_per_sum > 1:
-                c_batch = np.sum(c_discrete, axis=1)
-            else:
-                c_batch = c_discrete
-            if cs_cand is None:
-                cs_cand = c_batch
+        if interval_index is not None:
+            # costs scale with the number of activation runs -- no need to truncate
+            maximal_length = cell_states.shape[0]
+            run_length, run_positions, run_value = ai.count_active_runs(interval_index, cells, maximal_length)
+        elif query_mode != 'fast' and activation_index is None and sharded.enabled(maximal_length) \
+                and source not in self.unsigned_views:
+            # precise matching over the full timeline -- sharded over time ranges in worker processes
+            file_name, path = self.source_location(source)
+            run_length, run_positions, run_value = sharded.count_active_runs(
+                file_name, path, cells, activation_threshold_corrected, maximal_length)
+        else:
+            if activation_index is not None:
+                cs_cand = ai.count_active(activation_index, cells, 0, maximal_length)
             else:
-                cs_cand = cs_cand + c_batch
+                cs_cand = None
+                no_slices = int(np.ceil(len(cells) * 1. / num_of_cells_per_sum))
+                for c in range(0, no_slices):
+                    cell_range = cells[c * num_of_cells_per_sum:min((c + 1) * num_of_cells_per_sum, len(cells))]
+                    c_discrete = rs.active(cell_states, (slice(0, maximal_length), cell_range),
+                                           activation_threshold_corrected)
 
-            del c_discrete, c_batch
+                    c_batch = np.sum(c_discrete, axis=1)
+                    if cs_cand is None:
+                        cs_cand = c_batch
+                    else:
+                        cs_cand = cs_cand + c_batch
+
+                    del c_discrete, c_batch
+
+            run_length, run_positions, run_value = hf.rle(cs_cand)
+            del cs_cand
 
         test_cell_number = len(cells)
-        test_discrete = np.copy(cs_cand)
         collect_all_candidates = {}
         # start = time.time()
         while test_cell_number > 0 and len(collect_all_candidates) < num_candidates:
-            if test_cell_number != len(cells):
-                test_discrete[test_discrete > test_cell_number] = test_cell_number
-            length, positions, value = hf.rle(test_discrete)
-            # positions = np.array(positions)
+            # runs of "at least test_cell_number cells are active"
+            length, positions, value = hf.clip_runs(run_length, run_positions, run_value, test_cell_number)
+            # values of neighboring runs -- 0 beyond the sequence borders
+            value_left = np.append(0, value[:-1])
+            value_right = np.append(value[1:], 0)
+
             if phrase_length > 0:
                 indices = np.argwhere((value == test_cell_number) & (length == phrase_length))
             else:
@@ -408,15 +479,15 @@ class LSTMDataHandler:
             if constrain_left and not constrain_right:
 
                 len_pos = set(zip(length[indices].flatten().tolist(), positions[indices].flatten().tolist(),
-                                  (test_cell_number - value[indices - 1]).flatten().astype(int).tolist()))
+                                  (test_cell_number - value_left[indices]).flatten().astype(int).tolist()))
             elif not constrain_left and constrain_right:
 
                 len_pos = set(zip(length[indices].flatten().tolist(), positions[indices].flatten().tolist(),
-                                  (test_cell_number - value[indices + 1]).flatten().astype(int).tolist()))
+                                  (test_cell_number - value_right[indices]).flatten().astype(int).tolist()))
             elif constrain_left and constrain_right:
 
                 len_pos = set(zip(length[indices].flatten().tolist(), positions[indices].flatten().tolist(),
-                                  (test_cell_number - value[indices + 1] - value[indices - 1]).flatten().astype(
+                                  (test_cell_number - value_right[indices] - value_left[indices]).flatten().astype(
                                       int).tolist()))
             else:
                 len_pos = set(zip(length[indices].flatten().tolist(), positions[indices].flatten().tolist(),
@@ -442,99 +513,185 @@ class LSTMDataHandler:
 
         cell_count = len(cells)
 
-        res = []
-
-        max_pos = cell_states.shape[0]
-
-        for cand in all_candidates:  # positions where all pivot cells start jointly
-            ml = cand[0]  # maximal length of _all_ pivot cells on
-            pos = cand[1]  # position of the pattern
-
-            if pos < 1 or pos + ml + 1 > max_pos:
-                continue
-            # TODO: find a more elegant solution
-
-            cs = np.array(cell_states[pos - 1:pos + ml + 1, :])  # cell values of _all_ cells for the range
-            hf.threshold_discrete(cs, activation_threshold_corrected, -1, 1)  # discretize
-
-            # create pattern mask of form -1 1 1..1 -1 = off on on .. on off
-            mask = np.ones(ml + 2)
-            mask[0] = -1 if constrain_left else 0  # ignore if not constraint
-            mask[ml + 1] = -1 if constrain_right else 0  # ignore if not constraint
-
-            cs_sum = np.dot(mask, cs)
-            test_pattern_length = ml  # defines the length of the relevant pattern
-            test_pattern_length += 1 if constrain_left else 0
-            test_pattern_length += 1 if constrain_right else 0
-
-            all_active_cells = np.where(cs_sum == test_pattern_length)[0]  # all cells  that are active for range
-
-            intersect = np.intersect1d(all_active_cells, cells)  # intersection with selected cells
-            union = np.union1d(all_active_cells, cells)  # union with selected cells
-
-            res.append({'pos': pos,
-                        'factors': [pos, 0, ml,  # int(value[int(indices[ll2]) + 1])
-                                    (float(len(intersect)) / float(len(union))),  # Jaccard
-                                    cell_count - len(intersect), len(union),
-                                    len(intersect)]})  # how many selected cells are not active
-
-        def key(elem):
-            return -elem['factors'][6], elem['factors'][5], -elem['factors'][
-                2]  # largest intersection, smallest union, longest phrase
+        # score all candidates (positions where all pivot cells start jointly) at once
+        ml, pos, intersect, union = self._score_candidates(
+            all_candidates, cell_states, activation_index, activation_threshold_corrected, cells,
+            constrain_left, constrain_right)
+        jaccard = intersect / union.astype(float)
 
         meta = {}
         if add_histograms:
-            meta['fuzzy_length_histogram'] = np.bincount([x['factors'][2] for x in res])
-            meta['strict_length_histogram'] = np.bincount([x['factors'][2] for x in res if x['factors'][4] == 0])
+            meta['fuzzy_length_histogram'] = np.bincount(ml)
+            meta['strict_length_histogram'] = np.bincount(ml[intersect == cell_count])
 
         if phrase_length > 1:
-            res = [x for x in res if x['factors'][2] == phrase_length]
+            phrase = ml == phrase_length
+            ml, pos, intersect, union, jaccard = ml[phrase], pos[phrase], intersect[phrase], \
+                                                 union[phrase], jaccard[phrase]
 
-        res.sort(key=key)
+        # largest intersection, smallest union, longest phrase -- ties keep candidate order
+        top = hf.top_k([cell_count - intersect, union, (ml.max() - ml) if len(ml) else ml], no_of_results)
 
-        final_res = list(res[:no_of_results])
+        final_res = [{'pos': p,
+                      'factors': [p, 0, m, j,  # Jaccard
+                                  cell_count - i, u, i]}  # how many selected cells are not active
+                     for p, m, j, i, u in zip(pos[top].tolist(), ml[top].tolist(), jaccard[top].tolist(),
+                                              intersect[top].tolist(), union[top].tolist())]
 
         # for elem in final_res:
         #     print(elem, cell_count, -1. * (cell_count - elem[4]) / float(elem[3] + cell_count))
         # print(constrain_left, constrain_right)
-        del res
-        # print ('out cs 2:', '{:,}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
 
         return final_res, meta
 
-    def get_cached_matrix(self, data_transform, source, full_matrix=False):
-        """ request the cached full state matrix or a reference to it
-
-        :param data_transform: 'tanh' (values: 'tanh', 'raw')
+    def _score_candidates(self, candidates, cell_states, activation_index, threshold, cells,
+                          constrain_left, constrain_right):
+        """ compares the activation pattern of all cells with the selected cells for each candidate
+
+        Candidate ranges are read in large blocks (from the bit-packed index if available). Per block,
+        cumulative counts of inactive steps give all cells that are on for each candidate range at once.
+
+        :param candidates: list of (length, position, constraint score)
+        :param cell_states: state matrix
+        :param activation_index: bit-packed activation index or None
+        :param threshold: threshold applicable to the values in cell_states
+        :param cells: selected cells
+        :param constrain_left: cells have to be off before the range
+        :param constrain_right: cells have to be off after the range
+        :return: tuple of arrays (length, position, size of intersection, size of union) for all valid candidates
+        """
+        max_pos, n_cells = cell_states.shape[0], cell_states.shape[1]
+        cand = np.array([c[:2] for c in candidates], dtype=np.int64).reshape(-1, 2)
+        ml, pos = cand[:, 0], cand[:, 1]
+        valid = (pos >= 1) & (pos + ml + 1 <= max_pos)
+        ml, pos = ml[valid], pos[valid]
+
+        selected = np.zeros(n_cells, dtype=bool)
+        selected[cells] = True
+        n_selected = int(selected.sum())
+        intersect = np.zeros(len(pos), dtype=np.int64)
+        on_count = np.zeros(len(pos), dtype=np.int64)
+
+        max_rows = max(1, SCORE_BLOCK_SIZE // n_cells)
+        windows = list(zip((pos - 1).tolist(), (pos + ml + 1).tolist()))
+        spans, span_of = hf.merge_windows(windows, max_gap=max_rows // 8, max_span=max_rows)
+        span_of = np.array(span_of, dtype=np.int64)
+
+        for s, (start, end) in enumerate(spans):
+            if activation_index is not None:
+                active = ai.active_rows(activation_index, start, end, n_cells)
+            else:
+                active = rs.active(cell_states, slice(start, end), threshold)
+            inactive_cum = np.zeros((end - start + 1, n_cells), dtype=np.int32)
+            np.cumsum(~active, axis=0, out=inactive_cum[1:])
+
+            in_span = np.nonzero(span_of == s)[0]
+            for group in np.array_split(in_span, int(np.ceil(len(in_span) * n_cells / float(SCORE_BLOCK_SIZE)))):
+                first = pos[group] - start
+                last = first + ml[group]
+                all_on = inactive_cum[last] == inactive_cum[first]  # cells on for the whole range
+                if constrain_left:
+                    all_on &= ~active[first - 1]
+                if constrain_right:
+                    all_on &= ~active[last]
+                intersect[group] = np.sum(all_on[:, selected], axis=1)
+                on_count[group] = np.sum(all_on, axis=1)
+
+        return ml, pos, intersect, n_selected + on_count - intersect
+
+    def get_cached_matrix(self, data_transform, source):
+        """ request the state matrix with read access through the shared chunk cache
+
+        :param data_transform: 'tanh' (values: 'tanh', 'raw') -- cached row blocks hold untransformed values
         :param source: path in states.h5
-        :param full_matrix: requires the full matrix to be loaded
         :return: tuple(the matrix [reference], has the matrix been data_transformed)
         :rtype: (matrix, bool)
         """
+        if source not in self.cached_matrices:
+            if source in self.unsigned_views:
+                # derived from the cached signed matrix
+                matrix = us.UnsignedView(self.get_cached_matrix(data_transform, self.unsigned_views[source])[0])
+            else:
+                matrix = self.stored_matrix(source)
+                if source not in self.raw_states and self.cache.budget(self.cache_owner) > 0:
+                    # memory-mapped states are cached by the OS already
+                    matrix = ch.CachedMatrix(self.cache, self.cache_owner, source, matrix)
+            self.cached_matrices[source] = matrix
+
+        return self.cached_matrices[source], False
+
+    def share_states(self, directory):
+        """ copies states that are read from HDF5 into .npy files in directory (e.g. on /dev/shm)
+        and memory-maps them -- processes forked afterwards share one copy of all states
+
+        :param directory: output directory
+        """
+        for x in self.config['states']['types']:
+            source = self.stored_source(x['file'] + '::' + x['path'])
+            if source in self.raw_states:
+                continue
+            file_name = os.path.join(directory, self.cache_owner + '__' + rs.raw_file_name(source))
+            rs.export(self.stored_matrix(source), file_name)
+            self.raw_states[source] = np.load(file_name, mmap_mode='r')
+        self.cached_matrices = {}
+        self.cache.clear(self.cache_owner)
+
+    def reopen_files(self):
+        """ opens new HDF5 handles -- needed in forked processes, HDF5 handles must not be shared """
+        for key, h5 in self.h5_files.items():
+            self.h5_files[key] = h5py.File(h5.filename, 'r')
+        self.cached_matrices = {}
+
+    def stored_source(self, source):
+        """ the source that holds the stored values -- the signed source for unsigned views
+
+        :param source: source id in the format file::path
+        :rtype: str
+        """
+        return self.unsigned_views.get(source, source)
 
-        source_file = source.split('::')[0]
-        source = source.split('::')[1]
-        cache_id = str(source) + '__' + str(data_transform) + '__' + str(source_file)
-        # print 'cs:', '{:,}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-
-        if cache_id not in self.cached_matrix and full_matrix:
-            cell_states = self.h5_files[source_file][source]
-            if data_transform == 'tanh':
-                # x = np.zeros(shape=cell_states.shape)
-                x = np.clip(cell_states, -1, 1)
-                self.cached_matrix[cache_id] = x
-
-        if cache_id in self.cached_matrix:
-            transformed = True
-            matrix = self.cached_matrix[cache_id]
-        else:
-            transformed = False
-            matrix = self.h5_files[source_file][source]
-        # print 'cs:', '{:,}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    def stored_matrix(self, source):
+        """ the untransformed state matrix as stored on disk
+
+        :param source: source id in the format file::path
+        :return: np.memmap for sources with backend 'mmap' and a raw copy, HDF5 dataset otherwise
+            (wrapped in an UnsignedView for unsigned views)
+        """
+        if source in self.unsigned_views:
+            return us.UnsignedView(self.stored_matrix(self.unsigned_views[source]))
+        if source in self.raw_states:
+            return self.raw_states[source]
+
+        source_file, source = source.split('::')[:2]
+        return self.h5_files[source_file][source]
 
-        return matrix, transformed
+    def source_location(self, source):
+        """ where the stored state matrix of a source can be opened by other processes
+
+        :param source: source id in the format file::path
+        :return: tuple (file name, path in HDF5 file -- None for memory-mapped .npy files)
+            of the stored values -- the signed source for unsigned views
+        """
+        source = self.stored_source(source)
+        if source in self.raw_states:
+            return self.raw_states[source].filename, None
+
+        source_file, path = source.split('::')[:2]
+        return self.h5_files[source_file].filename, path
+
+    def source_version(self, source):
+        """ mtime and size of the stored state matrix -- changes whenever the states are rewritten
+
+        :param source: source id in the format file::path
+        :return: tuple (mtime, size)
+        """
+        stat = os.stat(self.source_location(source)[0])
+        return stat.st_mtime, stat.st_size
 
     def is_valid_source(self, source_id):
+        if source_id in self.unsigned_views:
+            return True
+
         split = source_id.split('::')
         if len(split) < 2:
             return False
@@ -542,8 +699,6 @@ class LSTMDataHandler:
         source_file = source_id.split('::')[0]
         source = source_id.split('::')[1]
 
-        b = source in self.h5_files[source_file]
-
         return (source_file in self.h5_files) and \
                (source in self.h5_files[source_file])
 
@@ -553,31 +708,61 @@ class LSTMDataHandler:
             res.append(x['file'] + '::' + x['path'])
         return res
 
+    def get_stats(self, source):
+        """ per-cell and global statistics of a source (see lstmdata.cell_stats.to_json)
+
+        :param source: source id
+        :return: dict or None if there are no statistics for source
+        """
+        if source not in self.cell_stats:
+            return None
+        return cs.to_json(self.cell_stats[source])
+
+    def index_search(self, _query, no_results=20, htmlFormat=False):
+        """ phrase search in the token index -- or in the Whoosh index if there is no token index
+
+        :param _query: whitespace separated tokens
+        :param no_results: maximal number of results
+        :param htmlFormat: highlight hits in the result texts
+        :return: list of {index, text}
+        """
+        ws = self.config['word_sequence']
+        if self.token_index is not None:
+            return self.token_index.query(_query, self.h5_files[ws['file']][ws['path']],
+                                          self.dicts[ws['dict_file']], no_results, htmlFormat)
+
+        import lstmdata.read_index as ri  # Whoosh is an optional dependency
+        return list(ri.query_index(_query, no_results, htmlFormat, dir=self.config['index_dir']))
+
+    def char_corpus(self):
+        """ character corpus with suffix array for regex_search -- memory-mapped on first use
+        (see tools/create_search_corpus.py)
+
+        :rtype: lstmdata.char_corpus.CharCorpus
+        """
+        if self._char_corpus is None:
+            with self._char_corpus_lock:
+                if self._char_corpus is None:
+                    ws = self.config['word_sequence']
+                    self._char_corpus = cc.load(
+                        self.directory, self.h5_files[ws['file']][ws['path']], self.dicts[ws['dict_file']],
+                        [self.h5_files[ws['file']].filename,
+                         os.path.join(self.directory, self.config['files'][ws['dict_file']])])
+        return self._char_corpus
+
     def regex_search(self, _query, no_results=20, htmlFormat=False):
         ws = self.config['word_sequence']
         word_sequence = self.h5_files[ws['file']][ws['path']]
+        mapper = self.dicts[ws['dict_file']]
+
+        hits = self.char_corpus().search(_query, no_results)
 
         ws_last_pos = len(word_sequence) - 1
-        pos = 0
-        hits = []
-        while pos < ws_last_pos and len(hits) < no_results:
-            upper_bound = min((pos + 10000), ws_last_pos)
-            word_ids = word_sequence[pos:upper_bound]
-
-            mapper = self.dicts_id_value[ws['dict_file']]
-            phrase = ''.join([mapper[x][0] for x in word_ids.tolist()])
-            r = [(m.start() + pos, m.end() + pos, m.group(0)) for m in re.finditer(_query, phrase)]
-            hits.extend(r)
-            if upper_bound < ws_last_pos:
-                pos = upper_bound - 1000
-            else:
-                pos = upper_bound
+        windows = [(max(start - 5, 0), min(end + 5, ws_last_pos)) for start, end in hits]
         res = []
-        for h in hits:
-            min_pos = max(h[0] - 5, 0)
-            max_pos = min(h[1] + 5, ws_last_pos)
-            text = ''.join([mapper[x] for x in word_sequence[min_pos:max_pos].tolist()])
-            res.append({'index': h[0], 'text': cgi.escape(text)})
+        for (start, _), word_ids in zip(hits, hf.read_windows(word_sequence, windows)):
+            text = ''.join(mapper.lookup(word_ids).tolist())
+            res.append({'index': start, 'text': html.escape(text, quote=False)})
         return res
 
         # if htmlFormat:
@@ -0,0 +1,138 @@
+import logging
+import os
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+CACHE_DIR_NAME = 'dict_cache'
+SEPARATOR = '\n'  # dict files are line based -- words never contain it
+
+
+def parse(file_name):
+    """ parses a dict file of format: value<space>id (a line starting with a space maps ' ' to the id)
+
+    :param file_name: dict file
+    :return: tuple (np.array of ids, list of words)
+    """
+    ids = []
+    words = []
+    with open(file_name, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                words.append(parts[0])
+                ids.append(int(parts[1]))
+            elif len(line) > 0 and line[0] == ' ':
+                words.append(' ')
+                ids.append(int(line.strip()))
+    return np.array(ids, dtype=np.int64), words
+
+
+class Dictionary:
+    def __init__(self, words, present):
+        """id -> word mapping backed by an object array indexed by id
+
+        :param words: np.array (dtype object) word for each id ('' for ids without entry)
+        :param present: np.array (bool) ids with an entry in the dict file
+        :rtype: None
+        """
+        self.words = words
+        self.present = present
+        self.size = int(np.count_nonzero(present))
+        self._ids = None
+
+    @classmethod
+    def from_entries(cls, ids, words):
+        """ dictionary from parallel lists of ids and words -- later entries win for duplicate ids """
+        ids = np.asarray(ids, dtype=np.int64)
+        table = np.empty(int(ids.max()) + 1 if len(ids) else 0, dtype=object)
+        table[:] = ''
+        table[ids] = np.array(words, dtype=object)
+        present = np.zeros(len(table), dtype=bool)
+        present[ids] = True
+        return cls(table, present)
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, word_ids):
+        """ words for an array of word ids (any shape) -- unknown ids map to ''
+
+        :param word_ids: np.array or list of ids
+        :return: np.array (dtype object) of the same shape
+        """
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        res = self.words.take(word_ids, mode='clip') if len(self.words) else \
+            np.full(word_ids.shape, '', dtype=object)
+        unknown = (word_ids < 0) | (word_ids >= len(self.words))
+        if unknown.any():
+            res[unknown] = ''
+        return res
+
+    def ids(self):
+        """ word -> id (lowest id for duplicate words) -- built on first use
+
+        :rtype: dict
+        """
+        if self._ids is None:
+            present_ids = np.flatnonzero(self.present)
+            self._ids = dict(zip(self.words[present_ids[::-1]].tolist(), present_ids[::-1].tolist()))
+        return self._ids
+
+    def values(self):
+        """ all words in order of id """
+        return self.words[self.present].tolist()
+
+    def items(self):
+        """ (id, word) for all ids with an entry """
+        present_ids = np.flatnonzero(self.present)
+        return zip(present_ids.tolist(), self.words[present_ids].tolist())
+
+
+def _fingerprint(file_name):
+    return np.array([os.path.getmtime(file_name), os.path.getsize(file_name)], dtype=np.float64)
+
+
+def cache_file_name(file_name):
+    return os.path.join(os.path.dirname(file_name), CACHE_DIR_NAME, os.path.basename(file_name) + '.npz')
+
+
+def _read_cache(file_name, fingerprint):
+    cache_file = cache_file_name(file_name)
+    if not os.path.isfile(cache_file):
+        return None
+    with np.load(cache_file) as cached:
+        if not np.array_equal(cached['fingerprint'], fingerprint):
+            return None
+        text = cached['table'].tobytes().decode('utf-8')
+        words = np.array(text.split(SEPARATOR) if len(cached['present']) else [], dtype=object)
+        return Dictionary(words, np.unpackbits(cached['present'], count=len(words)).astype(bool))
+
+
+def _write_cache(file_name, fingerprint, dictionary):
+    cache_file = cache_file_name(file_name)
+    try:
+        if not os.path.exists(os.path.dirname(cache_file)):
+            os.mkdir(os.path.dirname(cache_file))
+        table = SEPARATOR.join(dictionary.words.tolist()).encode('utf-8')
+        tmp_file = '{}.{}.tmp.npz'.format(cache_file, os.getpid())
+        np.savez(tmp_file, table=np.frombuffer(table, dtype=np.uint8), present=np.packbits(dictionary.present),
+                 fingerprint=fingerprint)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        logging.warning('cannot write dictionary cache %s', cache_file)
+
+
+def load(file_name):
+    """ loads a dict file -- from its binary cache (dict_cache/<name>.npz) if it is up to date
+
+    :param file_name: dict file of format: value<space>id
+    :rtype: Dictionary
+    """
+    fingerprint = _fingerprint(file_name)
+    res = _read_cache(file_name, fingerprint)
+    if res is None:
+        res = Dictionary.from_entries(*parse(file_name))
+        _write_cache(file_name, fingerprint, res)
+    return res
@@ -122,3 +122,141 @@ def threshold_discrete(arr, threshold, below, above):
     all_below_positions = arr < threshold
     arr[:] = above
     arr[all_below_positions] = below
+
+
+def window_bounds(pos_array, left, right, max_length):
+    """ [left_pos, right_pos) windows around positions, clipped to [0, max_length)
+
+    :param pos_array: list of positions
+    :param left: positions to the left
+    :param right: positions to the right
+    :param max_length: length of the underlying sequence
+    :return: list of (left_pos, right_pos)
+    """
+    return [(pos - min(left, pos), min(max_length, pos + 1 + right)) for pos in pos_array]
+
+
+def merge_windows(windows, max_gap=0, max_span=None):
+    """ merges overlapping or adjacent [start, end) windows into spans
+
+    :param windows: list of (start, end)
+    :param max_gap: also merge windows that are at most max_gap positions apart
+    :param max_span: don't grow spans beyond max_span positions by merging
+    :return: tuple (list of merged [start, end] spans, span index for each window)
+    :rtype: list, list
+    """
+    order = sorted(range(len(windows)), key=lambda i: windows[i][0])
+    spans = []
+    span_of = [0] * len(windows)
+    for i in order:
+        start, end = windows[i]
+        if spans and start <= spans[-1][1] + max_gap and \
+                (max_span is None or max(end, spans[-1][1]) - spans[-1][0] <= max_span):
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, max(start, end)])
+        span_of[i] = len(spans) - 1
+
+    return spans, span_of
+
+
+def read_windows(data, windows, columns=None):
+    """ reads many windows of a (HDF5) table with one read per merged span
+
+    :param data: table (HDF5 dataset or np.array), windows are applied to first axis
+    :param windows: list of (start, end)
+    :param columns: optional selection on the second axis
+    :return: list of arrays (views into the read spans) -- one for each window
+    :rtype: list
+    """
+    spans, span_of = merge_windows(windows)
+    blocks = [data[start:end] if columns is None else data[start:end, columns] for start, end in spans]
+
+    return [blocks[s][w[0] - spans[s][0]:w[1] - spans[s][0]] for w, s in zip(windows, span_of)]
+
+
+def read_rows(data, indices):
+    """ rows of a (HDF5) table for arbitrary, repeated indices -- each distinct row is read once
+
+    Distinct rows are read in sorted order with one fancy-indexed read, or as one contiguous
+    block if they cover at least half of their range.
+
+    :param data: table (HDF5 dataset or np.array), indices apply to first axis
+    :param indices: array of row indices
+    :return: np.array with one row per index
+    """
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    if isinstance(data, np.ndarray) or len(indices) == 0:
+        return np.asarray(data[indices])
+
+    unique, inverse = np.unique(indices, return_inverse=True)
+    first, last = int(unique[0]), int(unique[-1])
+    if last - first + 1 <= 2 * len(unique):
+        rows = data[first:last + 1][unique - first]
+    else:
+        rows = data[unique.tolist()]
+    return rows[inverse.reshape(-1)]
+
+
+def split_windows(values, windows):
+    """ splits rows that were read for consecutive windows into one array per window
+
+    :param values: np.array with the rows of all windows
+    :param windows: list of (start, end)
+    :return: list of arrays
+    """
+    lengths = [end - start for start, end in windows]
+    return np.split(values, np.cumsum(lengths)[:-1]) if lengths else []
+
+
+def merge_runs(lengths, positions, values):
+    """ merges neighboring runs with the same value
+
+    :param lengths: run lengths
+    :param positions: start positions of runs
+    :param values: values of runs
+    :returns: tuple (runlengths, startpositions, values)
+    """
+    keep = np.append(True, values[1:] != values[:-1])
+    end = positions[-1] + lengths[-1]
+    positions = positions[keep]
+
+    return np.diff(np.append(positions, end)), positions, values[keep]
+
+
+def clip_runs(lengths, positions, values, max_value):
+    """ run length encoding of np.minimum(x, max_value) computed from the run length encoding of x
+
+    :param lengths: run lengths of x
+    :param positions: start positions of runs of x
+    :param values: values of runs of x
+    :param max_value: clip value
+    :returns: tuple (runlengths, startpositions, values)
+    """
+    return merge_runs(lengths, positions, np.minimum(values, max_value))
+
+
+def top_k(keys, k):
+    """ indices of the k smallest entries, ordered lexicographically by keys (first key is primary).
+    Ties are resolved by index like in a stable sort, but only the k best entries are sorted
+    (selection by np.argpartition).
+
+    :param keys: list of non-negative integer arrays of the same length
+    :param k: number of entries
+    :return: indices of the k smallest entries in order
+    :rtype: np.ndarray
+    """
+    n = len(keys[0])
+    if n == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    composite = np.zeros(n, dtype=np.int64)
+    for key in keys:
+        composite = composite * (int(np.max(key)) + 1) + key
+
+    candidates = np.arange(n)
+    if n > k:
+        kth = composite[np.argpartition(composite, k - 1)[k - 1]]
+        candidates = np.nonzero(composite <= kth)[0]  # includes all ties of the k-th entry
+
+    return candidates[np.argsort(composite[candidates], kind='stable')][:k]
@@ -0,0 +1,76 @@
+import gzip
+import hashlib
+import json
+
+__author__ = 'Hendrik Strobelt'
+
+MIN_GZIP_BYTES = 1024  # smaller responses are sent uncompressed
+GZIP_LEVEL = 6
+
+
+def version(fingerprint):
+    """ short, stable id for a project fingerprint (see lstmdata.project_manifest.fingerprint)
+
+    :param fingerprint: JSON-serializable fingerprint
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def etag(*parts):
+    """ strong entity tag (quoted) for a response that is fully determined by parts
+
+    :param parts: strings, e.g. project version, request path and query, content type
+    :rtype: str
+    """
+    return '"' + hashlib.sha1('\n'.join(str(p) for p in parts).encode('utf-8')).hexdigest() + '"'
+
+
+def gzip_etag(tag):
+    """ the entity tag of the gzip-encoded variant of a response """
+    return tag[:-1] + '-gz"'
+
+
+def matching_etag(if_none_match, tag):
+    """ checks the If-None-Match header against the entity tag of a response (and its gzip variant)
+
+    :param if_none_match: value of the HTTP If-None-Match header
+    :param tag: entity tag of the uncompressed response
+    :return: the matching entity tag or None if the client has no valid copy
+    """
+    candidates = [x.strip() for x in (if_none_match or '').split(',')]
+    for candidate in (tag, gzip_etag(tag)):
+        if candidate in candidates:
+            return candidate
+    return tag if '*' in candidates else None
+
+
+def accepts_gzip(accept_encoding):
+    """ checks if the client accepts gzip (and did not disable it with q=0)
+
+    :param accept_encoding: value of the HTTP Accept-Encoding header
+    :rtype: bool
+    """
+    for coding in (accept_encoding or '').split(','):
+        parts = [x.strip() for x in coding.split(';')]
+        if parts[0] not in ('gzip', '*'):
+            continue
+        params = dict(p.split('=', 1) for p in parts[1:] if '=' in p)
+        try:
+            return float(params.get('q', 1)) > 0
+        except ValueError:
+            return True
+
+    return False
+
+
+def compress(body):
+    """ gzip-compressed body -- None if the body is too small to be worth it
+
+    :param body: response body
+    :type body: bytes
+    :rtype: bytes
+    """
+    if len(body) < MIN_GZIP_BYTES:
+        return None
+    return gzip.compress(body, GZIP_LEVEL)
@@ -0,0 +1,78 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = 'Hendrik Strobelt'
+
+
+class PoolFull(Exception):
+    """ raised if a BoundedPool has no free slot """
+    pass
+
+
+class BoundedPool:
+    def __init__(self, name, max_workers=4, max_pending=16):
+        """Thread pool for blocking handler calls (HDF5 reads, matching) with a bounded queue.
+        Calls that exceed workers + pending slots are rejected instead of piling up.
+        Threads are (re)created lazily in each process, so pools survive forking workers.
+
+        :param name: pool name (used for thread names)
+        :param max_workers: number of threads
+        :param max_pending: number of calls that may wait for a thread
+        :rtype: None
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._busy = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """ executor of this process and a slot in it -- None if there is no free slot """
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self._busy = 0
+                self._pid = os.getpid()
+            if self._busy >= self.max_workers + self.max_pending:
+                self.rejected += 1
+                return None
+            self._busy += 1
+            return self._executor
+
+    def _release(self, _=None):
+        with self._lock:
+            self._busy -= 1
+
+    def run(self, fn, *args, **kwargs):
+        """ runs fn(*args, **kwargs) in the pool and waits for the result
+
+        :raises PoolFull: if all workers are busy and the queue is full
+        :return: result of fn
+        """
+        executor = self._acquire()
+        if executor is None:
+            raise PoolFull(self.name)
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future.result()
+
+    def stats(self):
+        """ occupancy and rejected calls
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'busy': self._busy,
+                'rejected': self.rejected
+            }
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import threading
+
+from lstmdata.data_handler import LSTMDataHandler
+
+__author__ = 'Hendrik Strobelt'
+
+MANIFEST_FILE_NAME = 'lstmvis_manifest.json'
+
+
+def fingerprint(directory, config, config_file_name):
+    """ mtime and size of all files a project's info depends on
+
+    :param directory: project directory
+    :param config: configuration (YAML file content)
+    :param config_file_name: name of the config file inside directory
+    :return: dict file name -> [mtime, size] (None for missing files)
+    :rtype: dict
+    """
+    # raw copies are overwritten in place -- their manifest is rewritten on every export
+    file_names = [config_file_name, 'indexdir', 'token_index', 'cell_stats', 'raw_states',
+                  os.path.join('raw_states', 'manifest.json')] + sorted(config.get('files', {}).values())
+    res = {}
+    for file_name in file_names:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            res[file_name] = [stat.st_mtime, stat.st_size]
+        else:
+            res[file_name] = None
+    return res
+
+
+def read_manifest(directory):
+    manifest_file_name = os.path.join(directory, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_file_name):
+        return {}
+    try:
+        with open(manifest_file_name, 'r') as mf:
+            return json.load(mf)
+    except ValueError:
+        logging.warning('cannot parse project manifest %s -- rebuilding', manifest_file_name)
+        return {}
+
+
+def write_manifest(directory, manifest):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE_NAME), 'w') as mf:
+            json.dump(manifest, mf, indent=1)
+    except IOError:
+        logging.warning('cannot write project manifest to %s', directory)
+
+
+class LazyDataHandler:
+    def __init__(self, directory, config, info=None, **handler_args):
+        """Placeholder for a LSTMDataHandler that is created on first use.
+        All attributes and methods of the handler are available through it.
+
+        :param directory: base directory for lstm project
+        :param config: configuration (YAML file content)
+        :param info: cleaned-up enriched config (as served by /info) from the manifest, if up to date
+        :param handler_args: further arguments for LSTMDataHandler
+        :rtype: None
+        """
+        self.directory = directory
+        self.info = info
+        self._config = config
+        self._handler_args = handler_args
+        self._handler = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._handler is not None
+
+    @property
+    def handler(self):
+        """ the LSTMDataHandler -- opens files and parses dicts on first access
+
+        :rtype: LSTMDataHandler
+        """
+        if self._handler is None:
+            with self._lock:
+                if self._handler is None:
+                    logging.info('loading project %s', self.directory)
+                    self._handler = LSTMDataHandler(directory=self.directory, config=self._config,
+                                                    **self._handler_args)
+        return self._handler
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
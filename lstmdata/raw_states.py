@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+RAW_DIR_NAME = 'raw_states'
+MANIFEST_FILE_NAME = 'manifest.json'
+MAX_ROWS = 100000
+QUANTIZED_MAX = 127
+SATURATION = .999  # dequantized values on the tanh scale are clipped to +-SATURATION (arctanh(1) is inf)
+
+
+def raw_file_name(source):
+    """ file name for the raw copy of a source inside RAW_DIR_NAME
+
+    :param source: source id in the format file::path
+    :rtype: str
+    """
+    return source.replace('::', '__').replace('/', '.') + '.npy'
+
+
+def scale_file_name(file_name, tanh=False):
+    """ file with the per-cell scales of a quantized (int8) raw copy
+
+    :param tanh: scales of a copy that is quantized on the tanh scale
+    """
+    return os.path.splitext(file_name)[0] + ('.tanh_scale.npy' if tanh else '.scale.npy')
+
+
+def export(cell_states, out_file_name, dtype=None, transform='none'):
+    """ copies a state matrix (e.g. an HDF5 dataset) into a contiguous .npy file
+
+    For dtype int8 values are quantized with one scale per cell, the scales are written to
+    scale_file_name(out_file_name). States with transform tanh are quantized after tanh
+    (scale: tanh(max. absolute value) / 127) -- the error of displayed values is at most 0.5 / 127.
+    Other states are quantized linearly (scale: max. absolute value / 127).
+
+    :param cell_states: state matrix (time steps x cells)
+    :param out_file_name: .npy output file
+    :param dtype: output dtype (default: dtype of cell_states)
+    :param transform: transform of the states (tanh or none)
+    :return: (shape, dtype name) of the written matrix
+    """
+    dtype = np.dtype(dtype or cell_states.dtype)
+    tanh = dtype == np.int8 and transform == 'tanh'
+    scale = None
+    for old_scale_file in (scale_file_name(out_file_name), scale_file_name(out_file_name, tanh=True)):
+        if os.path.isfile(old_scale_file):
+            os.remove(old_scale_file)  # from a previous int8 export
+    if dtype == np.int8:
+        max_abs = np.zeros(cell_states.shape[1:], dtype=np.float64)
+        for slice_offset in range(0, cell_states.shape[0], MAX_ROWS):
+            block = np.abs(cell_states[slice_offset:slice_offset + MAX_ROWS])
+            np.maximum(max_abs, block.max(axis=0), out=max_abs)
+        scale = ((np.tanh(max_abs) if tanh else max_abs) / QUANTIZED_MAX).astype(np.float32)
+        np.save(scale_file_name(out_file_name, tanh), scale)
+        scale[scale == 0] = 1  # all-zero cells stay 0
+
+    out = np.lib.format.open_memmap(out_file_name, mode='w+', dtype=dtype, shape=cell_states.shape)
+    slice_offset = 0
+    while slice_offset < cell_states.shape[0]:
+        slice_end = min(slice_offset + MAX_ROWS, cell_states.shape[0])
+        block = cell_states[slice_offset:slice_end]
+        if scale is not None:
+            block = np.clip(np.rint((np.tanh(block) if tanh else block) / scale), -QUANTIZED_MAX, QUANTIZED_MAX)
+        out[slice_offset:slice_end] = block
+        slice_offset = slice_end
+        logging.info('slice: %i', slice_offset)
+
+    out.flush()
+    del out
+    return list(cell_states.shape), dtype.name
+
+
+class QuantizedMatrix:
+    def __init__(self, values, scale, tanh=False):
+        """read access to an int8 state matrix with per-cell scales -- dequantizes on read
+
+        Supports the slicing used in LSTMDataHandler: ``m[a:b]``, ``m[a:b, cols]`` and ``m[a:b, :]``.
+
+        :param values: quantized matrix (time steps x cells), e.g. np.memmap
+        :param scale: scale per cell
+        :param tanh: values are quantized after tanh (see export)
+        :rtype: None
+        """
+        self.values = values
+        self.scale = scale
+        self.tanh = tanh
+        self.shape = values.shape
+        self.dtype = np.dtype(np.float32)
+        self.filename = getattr(values, 'filename', None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _columns(self, item):
+        return item[1] if isinstance(item, tuple) and len(item) > 1 else slice(None)
+
+    def __getitem__(self, item):
+        res = self.values[item] * self.scale[self._columns(item)]
+        if self.tanh:
+            res = np.arctanh(np.clip(res, -SATURATION, SATURATION, out=res), out=res)
+        return res
+
+    def active(self, item, threshold):
+        """ cells that are on (value >= threshold) -- compared in the quantized domain
+
+        :param item: selection as for __getitem__
+        :param threshold: threshold applicable to the dequantized values
+        :return: bool np.array
+        """
+        scale = self.scale[self._columns(item)]
+        if self.tanh:
+            threshold = np.tanh(threshold)
+        # smallest quantized value that is on -- cells with scale 0 are always 0
+        q_threshold = np.where(scale > 0, np.ceil(threshold / np.where(scale > 0, scale, 1)),
+                               0 if threshold <= 0 else QUANTIZED_MAX + 1)
+        return self.values[item] >= np.clip(q_threshold, -QUANTIZED_MAX - 1, QUANTIZED_MAX + 1).astype(np.int16)
+
+
+def active(matrix, item, threshold):
+    """ cells that are on (value >= threshold) in a selection of a state matrix
+
+    :param matrix: state matrix (np.array, HDF5 dataset, QuantizedMatrix ...)
+    :param item: selection, e.g. ``(slice(a, b), cells)``
+    :param threshold: threshold applicable to the (dequantized) values
+    :return: bool np.array
+    """
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.active(item, threshold)
+    return ~(np.asarray(matrix[item]) < threshold)  # same as hf.threshold_discrete
+
+
+def open_states(file_name):
+    """ memory-maps a raw copy -- quantized copies are wrapped in a QuantizedMatrix
+
+    :param file_name: .npy file
+    :return: np.memmap or QuantizedMatrix
+    """
+    values = np.load(file_name, mmap_mode='r')
+    for tanh in (False, True):
+        if os.path.isfile(scale_file_name(file_name, tanh)):
+            return QuantizedMatrix(values, np.load(scale_file_name(file_name, tanh)), tanh)
+    return values
+
+
+def read_manifest(raw_dir):
+    manifest_file_name = os.path.join(raw_dir, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_file_name):
+        return {'sources': {}}
+    with open(manifest_file_name, 'r') as mf:
+        return json.load(mf)
+
+
+def write_manifest(raw_dir, manifest):
+    with open(os.path.join(raw_dir, MANIFEST_FILE_NAME), 'w') as mf:
+        json.dump(manifest, mf, indent=2)
+
+
+def load_states(directory, sources):
+    """ memory-maps the raw copies of sources
+
+    :param directory: project directory
+    :param sources: list of source ids (file::path)
+    :return: dict source -> np.memmap (sources without raw copy are missing)
+    :rtype: dict
+    """
+    raw_dir = os.path.join(directory, RAW_DIR_NAME)
+    manifest = read_manifest(raw_dir)['sources']
+    res = {}
+    for source in sources:
+        if source not in manifest:
+            logging.warning('no raw copy for %s -- using HDF5. Run tools/states_to_raw.py', source)
+            continue
+        res[source] = open_states(os.path.join(raw_dir, manifest[source]['file']))
+
+    return res
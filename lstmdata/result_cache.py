@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+__author__ = 'Hendrik Strobelt'
+
+MB = 1024 * 1024
+
+
+class _Flight:
+    def __init__(self):
+        """ a computation that identical concurrent requests wait for """
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * MB, directory=None):
+        """LRU cache for query results with a byte budget, optional on-disk persistence
+        and coalescing of identical concurrent requests (single-flight).
+
+        :param max_bytes: byte budget for results kept in memory (0 disables caching, not coalescing)
+        :param directory: directory for persisted results (None: memory only)
+        :rtype: None
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def set_directory(self, directory):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def get(self, key, compute):
+        """ cached result for key -- computed by compute() only once, even for concurrent calls
+
+        :param key: hashable, normalized request key (repr must be stable for persistence)
+        :param compute: function without parameters that computes the result
+        :return: the result -- shared between callers, don't modify it
+        """
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = self._load(key)
+            if value is None:
+                value = compute()
+                self._persist(key, value)
+            flight.value = value
+            self._add(key, value)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return value
+
+    def _add(self, key, value):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, dropped_size) = self.entries.popitem(last=False)
+                self.bytes -= dropped_size
+                self.evictions += 1
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _load(self, key):
+        if not self.directory or not os.path.isfile(self._file_name(key)):
+            return None
+        try:
+            with open(self._file_name(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (IOError, pickle.UnpicklingError, EOFError):
+            logging.warning('cannot read cached result %s', self._file_name(key))
+            return None
+        return value if stored_key == key else None
+
+    def _persist(self, key, value):
+        if not self.directory:
+            return
+        try:
+            with open(self._file_name(key), 'wb') as f:
+                pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+        except IOError:
+            logging.warning('cannot persist result to %s', self.directory)
+
+    def stats(self):
+        """ counters and memory usage
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'in_flight': len(self._flights)
+            }
+
+
+shared_results = ResultCache()
@@ -0,0 +1,90 @@
+import multiprocessing
+import threading
+
+import h5py
+import numpy as np
+
+import lstmdata.helper_functions as hf
+import lstmdata.raw_states as rs
+
+__author__ = 'Hendrik Strobelt'
+
+MAX_ROWS = 100000
+MIN_SHARD_LENGTH = 500000  # shorter timelines are not worth the inter-process overhead
+
+_workers = 0
+_pool = None
+_pool_lock = threading.Lock()  # matching runs in concurrent request threads
+
+
+def set_workers(workers):
+    """ number of processes used for sharded matching (0 or 1 disables sharding)
+
+    :param workers: number of worker processes
+    """
+    global _workers, _pool
+    with _pool_lock:
+        _workers = workers
+        if _pool is not None:
+            _pool.terminate()
+            _pool = None
+
+
+def enabled(length):
+    return _workers > 1 and length >= 2 * MIN_SHARD_LENGTH
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned workers don't inherit the HDF5 library state of the server process
+            _pool = multiprocessing.get_context('spawn').Pool(_workers)
+        return _pool
+
+
+def _shard_runs(task):
+    """ run length encoding of the active cell count for one time range -- runs in a worker process """
+    file_name, path, start, end, cells, threshold = task
+    if path is None:
+        data = rs.open_states(file_name)
+    else:
+        data = h5py.File(file_name, 'r')[path]
+
+    counts = np.zeros(end - start, dtype=np.int64)
+    slice_offset = start
+    while slice_offset < end:
+        slice_end = min(slice_offset + MAX_ROWS, end)
+        c_discrete = rs.active(data, (slice(slice_offset, slice_end), cells), threshold)
+        counts[slice_offset - start:slice_end - start] = np.sum(c_discrete, axis=1)
+        slice_offset = slice_end
+
+    if path is not None:
+        data.file.close()
+
+    lengths, positions, values = hf.rle(counts)
+    return lengths, positions + start, values
+
+
+def count_active_runs(file_name, path, cells, threshold, length):
+    """ run length encoding of the number of active cells (out of cells) for each time step
+    in [0, length) -- computed in shards over time ranges by a process pool
+
+    Runs that cross shard borders are stitched, so the result is the same as
+    ``hf.rle`` over the full count vector.
+
+    :param file_name: HDF5 file or .npy file (for memory-mapped states)
+    :param path: path in the HDF5 file, None for .npy files
+    :param cells: list of cell indices
+    :param threshold: threshold applicable to the stored values
+    :param length: number of time steps
+    :returns: tuple (runlengths, startpositions, values) -- same as hf.rle
+    """
+    n_shards = min(_workers * 4, int(np.ceil(length / float(MIN_SHARD_LENGTH))))
+    borders = np.linspace(0, length, n_shards + 1).astype(int)
+    tasks = [(file_name, path, int(start), int(end), list(cells), threshold)
+             for start, end in zip(borders[:-1], borders[1:])]
+
+    shard_runs = _get_pool().map(_shard_runs, tasks)
+
+    return hf.merge_runs(*[np.concatenate(x) for x in zip(*shard_runs)])
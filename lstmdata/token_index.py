@@ -0,0 +1,130 @@
+import html
+import json
+import os
+
+import numpy as np
+
+import lstmdata.helper_functions as hf
+
+__author__ = 'Hendrik Strobelt'
+
+INDEX_DIR_NAME = 'token_index'
+MANIFEST_FILE_NAME = 'manifest.json'
+OFFSETS_FILE_NAME = 'offsets.npy'
+POSITIONS_FILE_NAME = 'positions.npy'
+CONTEXT_LEFT = 2  # tokens before a hit in the result text
+CONTEXT_RIGHT = 5  # tokens from the hit on in the result text
+SEPARATOR = '||'
+
+
+def build(word_ids, vocab_size, out_dir):
+    """ writes the inverted index word id -> sorted positions in CSR layout:
+    positions of word id ``w`` are ``positions[offsets[w]:offsets[w + 1]]``
+
+    :param word_ids: word sequence (HDF5 dataset or np.array)
+    :param vocab_size: number of word ids (larger ids in word_ids extend it)
+    :param out_dir: output directory
+    :return: number of indexed positions
+    """
+    word_ids = np.asarray(word_ids[:]).reshape(-1)
+    pos_dtype = np.int32 if len(word_ids) < 2 ** 31 else np.int64
+    # a stable sort groups the positions by word id and keeps them sorted within each group
+    positions = np.argsort(word_ids, kind='stable').astype(pos_dtype)
+    counts = np.bincount(word_ids, minlength=vocab_size)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    np.save(os.path.join(out_dir, OFFSETS_FILE_NAME), offsets)
+    np.save(os.path.join(out_dir, POSITIONS_FILE_NAME), positions)
+    with open(os.path.join(out_dir, MANIFEST_FILE_NAME), 'w') as mf:
+        json.dump({'length': len(word_ids), 'vocab_size': len(counts)}, mf)
+    return len(word_ids)
+
+
+class TokenIndex:
+    def __init__(self, offsets, positions, id2word):
+        """phrase search on an inverted index word id -> positions (see build)
+
+        Query tokens are separated by whitespace and compared case-insensitively.
+
+        :param offsets: CSR offsets per word id
+        :param positions: positions of all word ids
+        :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+        :rtype: None
+        """
+        self.offsets = offsets
+        self.positions = positions
+        self.lower_ids = {}  # lowercase word -> word ids
+        for word_id, word in id2word.items():
+            if word_id < len(offsets) - 1:
+                self.lower_ids.setdefault(word.lower(), []).append(word_id)
+
+    def postings(self, word_ids):
+        """ sorted positions of all word_ids """
+        lists = [self.positions[self.offsets[w]:self.offsets[w + 1]] for w in word_ids]
+        if len(lists) == 1:
+            return np.asarray(lists[0])
+        return np.sort(np.concatenate(lists)) if lists else np.zeros(0, dtype=np.int64)
+
+    def phrase_positions(self, tokens):
+        """ start positions of a phrase -- by intersecting posting lists shifted by token offset
+
+        :param tokens: list of words
+        :return: sorted positions
+        """
+        if not tokens:
+            return np.zeros(0, dtype=np.int64)
+        token_ids = [self.lower_ids.get(t.lower(), []) for t in tokens]
+        sizes = [sum(int(self.offsets[w + 1] - self.offsets[w]) for w in ids) for ids in token_ids]
+
+        res = None
+        for k in np.argsort(sizes, kind='stable'):  # rarest token first
+            shifted = self.postings(token_ids[k]).astype(np.int64) - k
+            res = shifted if res is None else np.intersect1d(res, shifted, assume_unique=True)
+            if len(res) == 0:
+                break
+        return res
+
+    def query(self, _query, word_sequence, id2word, no_results=20, htmlFormat=False):
+        """ phrase query with results in the format of lstmdata.read_index.query_index
+
+        :param _query: whitespace separated tokens
+        :param word_sequence: word sequence (HDF5 dataset or np.array) for the result texts
+        :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+        :param no_results: maximal number of results
+        :param htmlFormat: highlight the hit in the result text
+        :return: list of {index, text} in order of position
+        """
+        tokens = _query.split()
+        hits = self.phrase_positions(tokens)[:no_results].tolist()
+        windows = [(max(pos - CONTEXT_LEFT, 0), min(pos + CONTEXT_RIGHT, len(word_sequence))) for pos in hits]
+
+        res = []
+        for pos, (start, _), word_ids in zip(hits, windows, hf.read_windows(word_sequence, windows)):
+            words = id2word.lookup(word_ids).tolist()
+            if htmlFormat:
+                words = [html.escape(w, quote=False) for w in words]
+                for k in range(len(tokens)):
+                    if pos - start + k < len(words):
+                        words[pos - start + k] = '<strong class="match term{0}">{1}</strong>'.format(
+                            k, words[pos - start + k])
+            words.insert(pos - start, SEPARATOR)
+            res.append({'index': pos, 'text': ' '.join(words)})
+        return res
+
+
+def load(directory, id2word):
+    """ memory-maps the token index of a project
+
+    :param directory: project directory
+    :param id2word: word dictionary (lstmdata.dictionary.Dictionary)
+    :return: TokenIndex or None if the project has no token index
+    """
+    index_dir = os.path.join(directory, INDEX_DIR_NAME)
+    if not os.path.isfile(os.path.join(index_dir, MANIFEST_FILE_NAME)):
+        return None
+    return TokenIndex(np.load(os.path.join(index_dir, OFFSETS_FILE_NAME), mmap_mode='r'),
+                      np.load(os.path.join(index_dir, POSITIONS_FILE_NAME), mmap_mode='r'),
+                      id2word)
@@ -0,0 +1,73 @@
+import logging
+
+import numpy as np
+
+__author__ = 'Hendrik Strobelt'
+
+MAX_ROWS = 100000
+
+
+def split_signed(values):
+    """ splits signed states into positive parts (first half of cells) and negated negative parts (second half)
+
+    :param values: signed states (time steps x cells)
+    :return: unsigned states (time steps x 2*cells)
+    """
+    values = np.asarray(values)
+    res = np.empty(values.shape[:-1] + (2 * values.shape[-1],), dtype=values.dtype)
+    np.maximum(values, 0, out=res[..., :values.shape[-1]])
+    np.negative(values, out=res[..., values.shape[-1]:])
+    np.maximum(res[..., values.shape[-1]:], 0, out=res[..., values.shape[-1]:])
+    return res
+
+
+class UnsignedView:
+    def __init__(self, signed):
+        """read access to the unsigned version of a signed state matrix -- derived on the fly
+
+        Cell ``i`` is the positive part of signed cell ``i``, cell ``n + i`` the negated negative part
+        (n: number of signed cells). Supports ``m[a:b]``, ``m[a:b, cols]`` and ``m[a:b, :]``.
+
+        :param signed: signed state matrix (HDF5 dataset, np.memmap, CachedMatrix ...)
+        :rtype: None
+        """
+        self.signed = signed
+        self.n_signed = signed.shape[1]
+        self.shape = (signed.shape[0], 2 * self.n_signed)
+        self.dtype = signed.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        rows, columns = (item[0], item[1]) if isinstance(item, tuple) and len(item) > 1 else (item, slice(None))
+        if isinstance(columns, slice) and columns == slice(None):
+            return split_signed(self.signed[rows])
+
+        columns = np.arange(self.shape[1])[columns] if isinstance(columns, slice) else np.asarray(columns)
+        # read each signed cell once -- sorted for HDF5
+        signed_columns, inverse = np.unique(columns % self.n_signed, return_inverse=True)
+        values = np.asarray(self.signed[rows, signed_columns.tolist()])[..., inverse]
+        values[..., columns >= self.n_signed] *= -1
+        np.maximum(values, 0, out=values)
+        return values
+
+
+def convert(data_in, data_out, name):
+    """ writes the unsigned version of a signed table in one streaming pass -- chunked and compressed
+
+    :param data_in: signed table (time steps x cells)
+    :param data_out: HDF5 file or group for the output
+    :param name: name of the output dataset
+    """
+    shape = data_in.shape
+    chunk_rows = max(1, min(shape[0], (1 << 20) // max(1, 2 * shape[1] * data_in.dtype.itemsize)))
+    x_out = data_out.create_dataset(name, (shape[0], shape[1] * 2), dtype=data_in.dtype,
+                                    chunks=(chunk_rows, shape[1] * 2), compression='gzip', compression_opts=4,
+                                    shuffle=True)
+    slice_offset = 0
+    while slice_offset < shape[0]:
+        slice_end = min(slice_offset + MAX_ROWS, shape[0])
+        x_out[slice_offset:slice_end] = split_signed(data_in[slice_offset:slice_end])
+        slice_offset = slice_end
+        logging.info('slice: %i', slice_offset)
@@ -4,6 +4,9 @@
 This Script does the preprocessing of a data set in form
 of a shifting window over the data. This is needed for
 the Saliency and the Word Influence Calculations.
+
+The windows are not stored: target, target_output and indices are
+virtual datasets over the word sequence (see windowed.py).
 """
 
 import os
@@ -13,9 +16,16 @@ import numpy
 import h5py
 import itertools
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import windowed
+
 __author__ = 'Sebastian Gehrmann'
 
 
+CHUNK_TOKENS = 1000000  # tokens converted and appended at once
+CHUNK_ROWS = 65536  # HDF5 chunk size of the base datasets
+
+
 class Indexer:
     def __init__(self):
         self.counter = 1
@@ -32,6 +42,18 @@ class Indexer:
             self.counter += 1
         return self.d[w]
 
+    def convert_all(self, words):
+        """ ids of a list of words as int32 array -- same ids as convert() word by word """
+        if not self._lock:
+            # new words in order of first occurrence
+            for w in dict.fromkeys(words):
+                if w not in self.d:
+                    self.convert(w)
+            ids = map(self.d.__getitem__, words)
+        else:
+            ids = map(self.d.get, words, itertools.repeat(self.d["<unk>"]))
+        return numpy.fromiter(ids, dtype=numpy.int32, count=len(words))
+
     def lock(self):
         self._lock = True
 
@@ -40,9 +62,24 @@ class Indexer:
         items = [(v, k) for k, v in self.d.items()]
         items.sort()
         for v, k in items:
-            print >>out, k, v
+            print(k, v, file=out)
         out.close()
-        
+
+
+def token_chunks(targetfile):
+    """ tokens of a text file in chunks of about CHUNK_TOKENS -- each line ends with </s> """
+    chunk = []
+    for targ_orig in targetfile:
+        targ_orig = targ_orig.replace("<eos>", "")
+        chunk += targ_orig.strip().split()
+        chunk.append("</s>")
+        if len(chunk) >= CHUNK_TOKENS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_data(args):
     target_indexer = Indexer()
     #add special words to indices in the target_indexer
@@ -50,52 +87,57 @@ def get_data(args):
     target_indexer.convert("<unk>")
     target_indexer.convert("</s>")
     
-    def convert(targetfile, batchsize, seqlength, outfile):
-        words = []
-        for i, targ_orig in enumerate(targetfile):
-            targ_orig = targ_orig.replace("<eos>", "")
-            targ = targ_orig.strip().split() + ["</s>"]
-            target_sent = [target_indexer.convert(w) for w in targ]
-            words += target_sent
-        #Don't let the shifting window get too big for memory reasons.     
-        words = words[:1200000]
-        # plus 1 for torch.
-        targ_output = numpy.array(words[1:] + \
-                                      [target_indexer.convert("</s>")])
-        words = numpy.array(words)
-        print (words.shape, "shape of the word array before preprocessing")
-        # Write output.
+    def convert(targetfile, batchsize, seqlength, outfile, max_tokens=None):
         f = h5py.File(outfile, "w")
 
+        # stream the word ids into a resizable base dataset -- plus </s> as target of the last word
+        sequence = f.create_dataset("sequence", (0,), maxshape=(None,), dtype=int, chunks=(CHUNK_ROWS,))
+        for chunk in token_chunks(targetfile):
+            # words after max_tokens are still added to the dictionary
+            ids = target_indexer.convert_all(chunk)
+            if max_tokens is not None:
+                ids = ids[:max(0, max_tokens - sequence.shape[0])]
+            if len(ids) == 0:
+                continue
+            sequence.resize((sequence.shape[0] + len(ids),))
+            sequence[-len(ids):] = ids
+        length = sequence.shape[0]
+        sequence.resize((length + 1,))
+        sequence[length] = target_indexer.convert("</s>")
+        print((length,), "shape of the word array before preprocessing")
+
+        # 1-based positions (for torch)
+        positions = f.create_dataset("positions", (length,), dtype=int,
+                                     chunks=(min(length, CHUNK_ROWS),) if length else None)
+        for start in range(0, length, CHUNK_TOKENS):
+            end = min(length, start + CHUNK_TOKENS)
+            positions[start:end] = numpy.arange(start + 1, end + 1)
+
         #number of batches of windows
-        size = words.shape[0] / (batchsize*seqlength)
-        size = size * seqlength - seqlength + 1 
-        print (size, "number of blocks after conversion")
+        size = windowed.number_of_batches(length, batchsize, seqlength)
+        print(size, "number of blocks after conversion")
 
-        original_index = numpy.array([i+1 for i, v in enumerate(words)])
-        
-        f["target"] = numpy.zeros((size, batchsize, seqlength), dtype=int)
-        f["indices"] = numpy.zeros((size, batchsize, seqlength), dtype=int) 
-        f["target_output"] = numpy.zeros((size, batchsize, seqlength), dtype=int) 
-        pos = 0
-        for row in range(batchsize):
-            for batch in range(size):
-
-                f["target"][batch, row] = words[pos:pos+seqlength]
-                f["indices"][batch, row] = original_index[pos:pos+seqlength]
-                f["target_output"][batch, row] = targ_output[pos:pos+seqlength]
-                pos = pos + 1
-            print (row+1)/float(batchsize)*100, "% processed"
+        # windows are virtual datasets that map into the base datasets -- no window is stored
+        f.attrs["batchsize"] = batchsize
+        f.attrs["seqlength"] = seqlength
+        f.attrs["size"] = size
+        windowed.create_windows(f, "target", "sequence", batchsize, seqlength, size)
+        windowed.create_windows(f, "target_output", "sequence", batchsize, seqlength, size, offset=1)
+        windowed.create_windows(f, "indices", "positions", batchsize, seqlength, size)
         f["target_size"] = numpy.array([target_indexer.counter])
 
-        f["words"] = words
-        f["set_size"] = words.shape[0]
+        words = h5py.VirtualLayout(shape=(length,), dtype=sequence.dtype)
+        words[:] = h5py.VirtualSource(".", "sequence", shape=(length + 1,), dtype=sequence.dtype)[:length]
+        f.create_virtual_dataset("words", words)
+        f["set_size"] = length
+        f.close()
 
-    convert(args.targetfile, args.batchsize, args.seqlength, args.outputfile + ".hdf5")
+    convert(args.targetfile, args.batchsize, args.seqlength, args.outputfile + ".hdf5", args.max_tokens)
     target_indexer.lock()
-    convert(args.targetvalfile, args.batchsize, args.seqlength, args.outputfile + "val" + ".hdf5")
+    convert(args.targetvalfile, args.batchsize, args.seqlength, args.outputfile + "val" + ".hdf5", args.max_tokens)
     target_indexer.write(args.outputfile + ".targ.dict")
     
+
 def main(arguments):
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -111,6 +153,9 @@ def main(arguments):
                         type=int)
     parser.add_argument('outputfile', help="HDF5 output file", 
                         type=str)
+    parser.add_argument('--max_tokens', help="Use only the first max_tokens words of each file "
+                        "(the Lua evaluators load the whole window tensor into memory)",
+                        type=int, default=None)
     args = parser.parse_args(arguments)
     get_data(args)
 
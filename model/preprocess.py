@@ -16,6 +16,11 @@ import itertools
 __author__ = 'Sebastian Gehrmann'
 
 
+CHUNK_TOKENS = 1000000  # tokens converted and appended at once
+BLOCK_TOKENS = 10000000  # tokens per bulk write of the batched tensors
+CHUNK_ROWS = 65536  # HDF5 chunk size (in tokens) of the output datasets
+
+
 class Indexer:
     def __init__(self):
         self.counter = 1
@@ -32,6 +37,18 @@ class Indexer:
             self.counter += 1
         return self.d[w]
 
+    def convert_all(self, words):
+        """ ids of a list of words as int32 array -- same ids as convert() word by word """
+        if not self._lock:
+            # new words in order of first occurrence
+            for w in dict.fromkeys(words):
+                if w not in self.d:
+                    self.convert(w)
+            ids = map(self.d.__getitem__, words)
+        else:
+            ids = map(self.d.get, words, itertools.repeat(self.d["<unk>"]))
+        return numpy.fromiter(ids, dtype=numpy.int32, count=len(words))
+
     def lock(self):
         self._lock = True
 
@@ -40,9 +57,24 @@ class Indexer:
         items = [(v, k) for k, v in self.d.items()]
         items.sort()
         for v, k in items:
-            print >>out, k, v
+            print(k, v, file=out)
         out.close()
-        
+
+
+def token_chunks(targetfile):
+    """ tokens of a text file in chunks of about CHUNK_TOKENS -- each line ends with </s> """
+    chunk = []
+    for targ_orig in targetfile:
+        targ_orig = targ_orig.replace("<eos>", "")
+        chunk += targ_orig.strip().split()
+        chunk.append("</s>")
+        if len(chunk) >= CHUNK_TOKENS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_data(args):
     target_indexer = Indexer()
     #add special words to indices in the target_indexer
@@ -51,47 +83,52 @@ def get_data(args):
     target_indexer.convert("</s>")
     
     def convert(targetfile, batchsize, seqlength, outfile):
-        words = []
-        wordschar = []
-        targets = []
-        for i, targ_orig in enumerate(targetfile):
-            targ_orig = targ_orig.replace("<eos>", "")
-            targ = targ_orig.strip().split() + ["</s>"]
-            #here put something for shifting window
-            target_sent = [target_indexer.convert(w) for w in targ]
-            words += target_sent
-
-        # plus 1 for torch.
-        targ_output = numpy.array(words[1:] + [target_indexer.convert("</s>")])
-        words = numpy.array(words)
-        print (words.shape, "shape of the word array before preprocessing")
-        # Write output.
         f = h5py.File(outfile, "w")
-        size = words.shape[0] / (batchsize * seqlength)
-        print (size, "number of blocks after conversion")
 
-        original_index = numpy.array([i+1 for i, v in enumerate(words)])
-        
-        f["target"] = numpy.zeros((size, batchsize, seqlength), dtype=int)
-        f["indices"] = numpy.zeros((size, batchsize, seqlength), dtype=int) 
-        f["target_output"] = numpy.zeros((size, batchsize, seqlength), dtype=int) 
-        pos = 0
+        # stream the word ids into a resizable dataset
+        words = f.create_dataset("words", (0,), maxshape=(None,), dtype=int, chunks=(CHUNK_ROWS,))
+        for chunk in token_chunks(targetfile):
+            ids = target_indexer.convert_all(chunk)
+            words.resize((words.shape[0] + len(ids),))
+            words[-len(ids):] = ids
+        length = words.shape[0]
+        print((length,), "shape of the word array before preprocessing")
+
+        size = length // (batchsize * seqlength)
+        print(size, "number of blocks after conversion")
+
+        # row r of the batches holds the r-th of batchsize consecutive segments of the text:
+        # tensor = words[:size * batchsize * seqlength].reshape(batchsize, size, seqlength).transpose(1, 0, 2)
+        # target_output is shifted by one (plus </s> at the end), indices are 1-based positions (for torch)
+        block_batches = max(1, min(size, BLOCK_TOKENS // seqlength))
+        # empty tensors (less than batchsize * seqlength tokens) can't be chunked
+        chunks = (max(1, min(size, CHUNK_ROWS // seqlength)), 1, seqlength) if size > 0 else None
+        target = f.create_dataset("target", (size, batchsize, seqlength), dtype=int, chunks=chunks)
+        indices = f.create_dataset("indices", (size, batchsize, seqlength), dtype=int, chunks=chunks)
+        target_output = f.create_dataset("target_output", (size, batchsize, seqlength), dtype=int, chunks=chunks)
+        end_id = target_indexer.convert("</s>")
         for row in range(batchsize):
-            for batch in range(size):
-                f["target"][batch, row] = words[pos:pos+seqlength]
-                f["indices"][batch, row] = original_index[pos:pos+seqlength]
-                f["target_output"][batch, row] = targ_output[pos:pos+seqlength]
-                pos = pos + seqlength
+            for batch in range(0, size, block_batches):
+                batch_end = min(size, batch + block_batches)
+                start = (row * size + batch) * seqlength
+                end = (row * size + batch_end) * seqlength
+                block = words[start:end + 1]
+                if len(block) == end - start:
+                    block = numpy.append(block, end_id)
+                target[batch:batch_end, row] = block[:-1].reshape(-1, seqlength)
+                target_output[batch:batch_end, row] = block[1:].reshape(-1, seqlength)
+                indices[batch:batch_end, row] = numpy.arange(start + 1, end + 1).reshape(-1, seqlength)
         f["target_size"] = numpy.array([target_indexer.counter])
 
-        f["words"] = words
-        f["set_size"] = words.shape[0]
+        f["set_size"] = length
+        f.close()
 
     convert(args.targetfile, args.batchsize, args.seqlength, args.outputfile + ".hdf5")
     target_indexer.lock()
     convert(args.targetvalfile, args.batchsize, args.seqlength, args.outputfile + "-val" + ".hdf5")
     target_indexer.write(args.outputfile + ".dict")
     
+
 def main(arguments):
     parser = argparse.ArgumentParser(
         description=__doc__,
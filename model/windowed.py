@@ -0,0 +1,77 @@
+"""
+Shifting windows over a word sequence -- stored and read as views of the sequence, never copied.
+
+With ``size`` batches, window ``(batch, row)`` holds the ``seqlength`` tokens that start at
+position ``row * size + batch``. The windowed datasets of preprocess-shifting-window.py are HDF5
+virtual datasets that map into a 1D base dataset; their attributes ``source`` and ``offset``
+(first position) describe the window layout together with the file attributes ``batchsize``,
+``seqlength`` and ``size``.
+"""
+
+import h5py
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+__author__ = 'Sebastian Gehrmann'
+
+BLOCK_TOKENS = 10000000  # tokens read at once by iterate_batches
+
+
+def number_of_batches(length, batchsize, seqlength):
+    """ number of windows per row for a sequence of length tokens """
+    return max(0, (length // (batchsize * seqlength)) * seqlength - seqlength + 1)
+
+
+def window_view(sequence, batchsize, seqlength, size, offset=0):
+    """ all windows as read-only (size, batchsize, seqlength) view of a 1D array -- no copy
+
+    :param sequence: 1D np.array
+    :param offset: position of the first token of the first window
+    """
+    sequence = numpy.asarray(sequence)[offset:]
+    if size > 0 and len(sequence) < (batchsize - 1) * size + size - 1 + seqlength:
+        raise ValueError('sequence too short for {0} batches'.format(size))
+    stride = sequence.strides[0]
+    return as_strided(sequence, shape=(size, batchsize, seqlength), strides=(stride, size * stride, stride),
+                      writeable=False)
+
+
+def create_windows(f, name, source, batchsize, seqlength, size, offset=0):
+    """ creates a windowed (size, batchsize, seqlength) virtual dataset over the 1D dataset source
+
+    :param f: HDF5 file that holds source
+    :param name: name of the new dataset
+    :param source: name of the base dataset in f
+    :param offset: position of the first token of the first window
+    """
+    base = f[source]
+    layout = h5py.VirtualLayout(shape=(size, batchsize, seqlength), dtype=base.dtype)
+    base_source = h5py.VirtualSource('.', source, shape=base.shape, dtype=base.dtype)  # '.' -- same file
+    if size > 0:
+        for row in range(batchsize):
+            for j in range(seqlength):
+                start = offset + row * size + j
+                layout[:, row, j] = base_source[start:start + size]
+    windows = f.create_virtual_dataset(name, layout)
+    windows.attrs['source'] = source
+    windows.attrs['offset'] = offset
+    return windows
+
+
+def iterate_batches(file_name, name='target'):
+    """ yields the (batchsize, seqlength) windows of all batches in order -- reads blocks of the base dataset
+
+    :param file_name: HDF5 file written by preprocess-shifting-window.py
+    :param name: windowed dataset (target, target_output or indices)
+    """
+    with h5py.File(file_name, 'r') as f:
+        batchsize, seqlength, size = [int(f.attrs[k]) for k in ('batchsize', 'seqlength', 'size')]
+        base = f[f[name].attrs['source']]
+        offset = int(f[name].attrs['offset'])
+        block_batches = max(1, BLOCK_TOKENS // (batchsize * seqlength))
+        for batch in range(0, size, block_batches):
+            batch_end = min(size, batch + block_batches)
+            rows = [window_view(base[offset + row * size + batch:offset + row * size + batch_end + seqlength - 1],
+                                1, seqlength, batch_end - batch)[:, 0] for row in range(batchsize)]
+            for k in range(batch_end - batch):
+                yield numpy.stack([windows[k] for windows in rows])
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+from optparse import OptionParser
+
+import h5py
+import itertools
+import logging
+import os
+import sys
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lstmdata.activation_index as ai
+import lstmdata.unsigned as us
+
+__author__ = 'Hendrik Strobelt'
+
+CONFIG_FILE_NAME = 'lstm.yml'
+
+
+def configuration(project_dir):
+    """
+    checks, if dir and config file exist. if so, returns it as python dict.
+    :param project_dir:
+    :return: config dictionary
+    """
+    config_file_name = os.path.join(project_dir, CONFIG_FILE_NAME)
+    if not os.path.isfile(config_file_name):
+        logging.error('no config file found: %s', config_file_name)
+        sys.exit(-1)
+
+    with open(config_file_name, 'r') as cf:
+        return yaml.load(cf, Loader=yaml.FullLoader)
+
+
+def index_project(project_dir, options):
+    config = configuration(project_dir)
+    thresholds = [float(x) for x in options.thresholds.split(',')]
+    transforms = options.transforms.split(',')
+    kinds = options.kinds.split(',')
+
+    index_dir = os.path.join(project_dir, ai.INDEX_DIR_NAME)
+    if not os.path.exists(index_dir):
+        os.mkdir(index_dir)
+
+    # keep entries of sources that are not re-indexed
+    manifest = ai.read_manifest(index_dir)
+    entries = {ai.index_key(e['source'], e['transform'], e['threshold']) + (e.get('kind', ai.BITS),): e
+               for e in manifest['entries']}
+
+    default_state_file = config['states']['file']
+    for x in config['states']['types']:
+        state_file = x.get('file', default_state_file)
+        source = state_file + '::' + x['path']
+        file_name = os.path.join(project_dir, config['files'][state_file])
+        fingerprint = [os.path.getmtime(file_name), os.path.getsize(file_name)]
+        with h5py.File(file_name, 'r') as h5:
+            cell_states = us.UnsignedView(h5[x['signed_path']]) if 'signed_path' in x else h5[x['path']]
+            for threshold, kind in itertools.product(thresholds, kinds):
+                # the threshold on raw values does not depend on the transform,
+                # so one index file serves all requested transforms
+                index_file_name = ai.index_file_name(source, transforms[0], threshold)
+                logging.info('indexing %s (threshold %g, %s) -> %s', source, threshold, kind, index_file_name)
+                if kind == ai.BITS:
+                    ai.build_index(cell_states, os.path.join(index_dir, index_file_name),
+                                   ai.corrected_threshold(threshold))
+                else:
+                    index_file_name = os.path.splitext(index_file_name)[0]
+                    ai.build_intervals(cell_states, os.path.join(index_dir, index_file_name),
+                                       ai.corrected_threshold(threshold))
+
+                for transform in transforms:
+                    entries[ai.index_key(source, transform, threshold) + (kind,)] = {
+                        'source': source,
+                        'transform': transform,
+                        'threshold': threshold,
+                        'kind': kind,
+                        'file': index_file_name,
+                        'length': cell_states.shape[0],
+                        'cells': cell_states.shape[1],
+                        'fingerprint': fingerprint
+                    }
+
+    manifest['entries'] = list(entries.values())
+    ai.write_manifest(index_dir, manifest)
+    logging.info(' .. done.')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] <project_directory>\n'
+                                'Creates activation indices for all states of a LSTMVis project.')
+    parser.add_option('-t', help="comma separated activation thresholds", type=str, default="0.3",
+                      dest='thresholds')
+    parser.add_option('-x', help="comma separated data transforms", type=str, default="tanh",
+                      dest='transforms')
+    parser.add_option('-k', help="comma separated index kinds: bits, intervals", type=str,
+                      default="bits,intervals", dest='kinds')
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
+    if len(args) != 1:
+        parser.print_help()
+    else:
+        index_project(args[0], options)
+
+
+if __name__ == '__main__':
+    main()
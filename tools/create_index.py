@@ -2,15 +2,24 @@
 from optparse import OptionParser
 
 import h5py
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import sys
+import time
 import yaml
-from whoosh.index import create_in, os
-from whoosh.fields import *
-from whoosh.analysis import *
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lstmdata.dictionary as wd
+import lstmdata.token_index as ti
+
 __author__ = 'Hendrik Strobelt'
 
 CONFIG_FILE_NAME = 'lstm.yml'
+MAX_ROWS = 200000  # documents built at once
+WINDOW = 7  # tokens per document
 
 
 def configuration(project_dir):
@@ -33,39 +42,26 @@ def configuration(project_dir):
     # config = {}
     try:
         with open(config_file_name, 'r') as cf:
-            res = yaml.load(cf)
+            res = yaml.load(cf, Loader=yaml.FullLoader)
     except IOError:
         logging.error('cannot read config file')
         sys.exit(-1)
     return res
 
 
-def dictionary(project_dir, config):
+def vocabulary(project_dir, config):
     """
     loads the word dictionary file
     :param project_dir:
     :param config:
-    :return: id2word dictionary
+    :return: word for each id as np.array -- for vectorized lookups
     """
-    id2word = {}
     dict_file_name = os.path.join(project_dir, config['files'][config['word_sequence']['dict_file']])
     try:
-        with open(dict_file_name, 'r') as df:
-            for line in df:
-                if len(line.split()) == 2:
-                    k, v = line.split()
-                elif line[0] == " ":
-                    k = " "
-                    v = line.strip()
-                try:
-                    id2word[int(v)] = unicode(k, 'utf-8')
-                except UnicodeError:
-                    logging.error('unicode error in: %s', line)
-                    break
+        return wd.load(dict_file_name).words
     except IOError:
         logging.error('cannot read dict file %s', dict_file_name)
         sys.exit(-1)
-    return id2word
 
 
 def sequence_data(project_dir, config):
@@ -76,7 +72,7 @@ def sequence_data(project_dir, config):
     :return: pointer to word sequence array
     """
     try:
-        h5_seq = h5py.File(os.path.join(project_dir, config['files'][config['word_sequence']['file']]))
+        h5_seq = h5py.File(os.path.join(project_dir, config['files'][config['word_sequence']['file']]), 'r')
     except IOError:
         logging.error('cannot open HDF5 file %s', config['files'][config['word_sequence']['file']])
         sys.exit(-1)
@@ -84,50 +80,121 @@ def sequence_data(project_dir, config):
     return res
 
 
-def index_project(project_dir, options):
+def token_index_project(project_dir, options):
     config = configuration(project_dir)
+    sequence = sequence_data(project_dir=project_dir, config=config)
 
-    id2word = dictionary(project_dir=project_dir, config=config)
+    logging.info('building token index')
+    length = ti.build(sequence, 0, os.path.join(project_dir, ti.INDEX_DIR_NAME))
+    logging.info(' .. done. %i positions indexed.', length)
 
-    sequence = sequence_data(project_dir=project_dir, config=config)
+
+def documents(sequence, vocab, start, end):
+    """
+    builds the documents for positions [start, end) in one vectorized pass.
+    Document i holds the tokens i-7 .. i-1 with '||' in front of token i-5.
+    :param sequence: word sequence
+    :param vocab: word for each id (see vocabulary)
+    :param start: first position (>= 7)
+    :param end: end position
+    :return: (document indices, document contents)
+    """
+    n = end - start
+    words = vocab[np.asarray(sequence[start - WINDOW:end - 1])]
+    content = words[0:n] + ' ' + words[1:n + 1] + ' || ' + words[2:n + 2]
+    for j in range(3, WINDOW):
+        content = content + ' ' + words[j:j + n]
+    return range(start - 5, end - 5), content
+
+
+def schema():
+    from whoosh.fields import Schema, NUMERIC, TEXT
+    from whoosh.analysis import SpaceSeparatedTokenizer, LowercaseFilter
 
     my_analyzer = SpaceSeparatedTokenizer() | LowercaseFilter()
+    return Schema(index=NUMERIC(stored=True),
+                  content=TEXT(stored=True, analyzer=my_analyzer))
+
 
-    schema = Schema(index=NUMERIC(stored=True),
-                    content=TEXT(stored=True, analyzer=my_analyzer))
+def index_shard(task):
+    """
+    writes the documents for positions [start, end) into a separate Whoosh index -- runs in a worker process
+    :param task: (project_dir, shard_dir, start, end)
+    :return: number of documents
+    """
+    from whoosh.index import create_in
+
+    project_dir, shard_dir, start, end = task
+    config = configuration(project_dir)
+    vocab = vocabulary(project_dir=project_dir, config=config)
+    sequence = sequence_data(project_dir=project_dir, config=config)
+
+    os.mkdir(shard_dir)
+    writer = create_in(shard_dir, schema()).writer(limitmb=256)
+    for block_start in range(start, end, MAX_ROWS):
+        indices, contents = documents(sequence, vocab, block_start, min(end, block_start + MAX_ROWS))
+        for i, a in zip(indices, contents.tolist()):
+            writer.add_document(index=i, content=a)
+    writer.commit()
+    sequence.file.close()
+    return end - start
+
+
+def index_project(project_dir, options):
+    # Whoosh is only needed for this (slower and larger) index
+    from whoosh.index import create_in, open_dir
+
+    config = configuration(project_dir)
+    length = len(sequence_data(project_dir=project_dir, config=config))
+    vocabulary(project_dir=project_dir, config=config)  # builds the dictionary cache for the workers
 
     # create new dir if it doesn't exist yet
     index_dir_path = os.path.join(project_dir, 'indexdir')
     if not os.path.exists(index_dir_path):
         os.mkdir(index_dir_path)
-
-    # create index
-    ix = create_in(index_dir_path, schema)
-    writer = ix.writer(limitmb=1024, procs=4)  # uses up to 4GB of RAM
-    logging.info('starting indexing')
-    for i in range(7, len(sequence)):
-        tokens = map(lambda x: id2word[x], sequence[i - 7:i])
-        tokens.insert(2, '||')
-        a = u" ".join(tokens)
-        writer.add_document(index=(i - 5),
-                            content=a)
-        if i % 10000 == 0:
-            logging.info('pos: %i, string: %s', i, a)
-
-    logging.info(' writing index...')
+    shards_dir_path = os.path.join(project_dir, 'indexdir_shards')
+    if os.path.exists(shards_dir_path):
+        shutil.rmtree(shards_dir_path)
+    os.mkdir(shards_dir_path)
+
+    # shards of the corpus are indexed in parallel -- each into its own index
+    bounds = np.linspace(WINDOW, max(WINDOW, length), options.processes * 4 + 1).astype(int)
+    tasks = [(project_dir, os.path.join(shards_dir_path, str(k)), int(start), int(end))
+             for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end > start]
+
+    logging.info('starting indexing of %i positions with %i processes', length, options.processes)
+    t0 = time.time()
+    done = 0
+    pool = multiprocessing.Pool(options.processes)
+    for n in pool.imap_unordered(index_shard, tasks):
+        done += n
+        logging.info('pos: %i / %i (%.0f positions/s)', done, length - WINDOW, done / (time.time() - t0))
+    pool.close()
+
+    logging.info(' merging %i segments...', len(tasks))
+    writer = create_in(index_dir_path, schema()).writer(limitmb=1024)
+    for _, shard_dir, _, _ in tasks:
+        writer.add_reader(open_dir(shard_dir).reader())
     writer.commit()
-    logging.info(' .. done.')
+    shutil.rmtree(shards_dir_path)
+    logging.info(' .. done in %.0fs.', time.time() - t0)
 
 
 def main():
     parser = OptionParser(usage='%prog [options] <project_directory>\nCreates an search index for LSTMVis.')
+    parser.add_option('-w', help="create a Whoosh index instead of the token index (requires Whoosh)",
+                      action='store_true', default=False, dest='whoosh')
+    parser.add_option('-p', help="processes for the Whoosh index", type=int, default=multiprocessing.cpu_count(),
+                      dest='processes')
 
     (options, args) = parser.parse_args()
     logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
     if len(args) != 1:
         parser.print_help()
-    else:
+    elif options.whoosh:
         index_project(args[0], options)
+    else:
+        token_index_project(args[0], options)
 
 
 if __name__ == '__main__':
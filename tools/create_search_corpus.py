@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+from optparse import OptionParser
+
+import h5py
+import logging
+import os
+import sys
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lstmdata.char_corpus as cc
+import lstmdata.dictionary as wd
+
+__author__ = 'Hendrik Strobelt'
+
+CONFIG_FILE_NAME = 'lstm.yml'
+
+
+def configuration(project_dir):
+    """
+    checks, if dir and config file exist. if so, returns it as python dict.
+    :param project_dir:
+    :return: config dictionary
+    """
+    config_file_name = os.path.join(project_dir, CONFIG_FILE_NAME)
+    if not os.path.isfile(config_file_name):
+        logging.error('no config file found: %s', config_file_name)
+        sys.exit(-1)
+
+    with open(config_file_name, 'r') as cf:
+        return yaml.load(cf, Loader=yaml.FullLoader)
+
+
+def create_corpus(project_dir):
+    config = configuration(project_dir)
+    ws = config['word_sequence']
+    word_file = os.path.join(project_dir, config['files'][ws['file']])
+    dict_file = os.path.join(project_dir, config['files'][ws['dict_file']])
+
+    logging.info('building character corpus and suffix array for %s', project_dir)
+    with h5py.File(word_file, 'r') as h5:
+        length = cc.build(project_dir, h5[ws['path']], wd.load(dict_file), [word_file, dict_file])
+
+    logging.info('done. %i characters written to %s', length, os.path.join(project_dir, cc.CORPUS_DIR_NAME))
+
+
+def main():
+    parser = OptionParser(usage='%prog <project_directory>\n'
+                                'Builds the character corpus and suffix array for regex search '
+                                '(etc: regex_search: true) of a LSTMVis project.')
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
+    if len(args) != 1:
+        parser.print_help()
+    else:
+        create_corpus(args[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,138 @@
+#! /usr/bin/env python
 from optparse import OptionParser
 
+import h5py
 import logging
+import multiprocessing
 import numpy as np
+import os
+import sys
+import yaml
 
-import h5py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lstmdata.cell_stats as cs
+import lstmdata.unsigned as us
 
 __author__ = 'Hendrik Strobelt'
 
+CONFIG_FILE_NAME = 'lstm.yml'
+RANGES_PER_PROCESS = 4
+
+
+def configuration(project_dir):
+    """
+    checks, if dir and config file exist. if so, returns it as python dict.
+    :param project_dir:
+    :return: config dictionary
+    """
+    config_file_name = os.path.join(project_dir, CONFIG_FILE_NAME)
+    if not os.path.isfile(config_file_name):
+        logging.error('no config file found: %s', config_file_name)
+        sys.exit(-1)
+
+    with open(config_file_name, 'r') as cf:
+        return yaml.load(cf, Loader=yaml.FullLoader)
+
+
+def accumulate_range(task):
+    """
+    statistics of a row range -- runs in a worker process
+    :param task: (h5 file name, path, derive unsigned states, start, end, activation cutoffs)
+    :return: lstmdata.cell_stats.Accumulator
+    """
+    file_name, path, unsigned, start, end, limits = task
+    with h5py.File(file_name, 'r') as h5:
+        data = us.UnsignedView(h5[path]) if unsigned else h5[path]
+        return cs.accumulate(data, start, end, limits)
+
+
+def table_stats(file_name, path, unsigned, limits, processes):
+    """
+    streams over a table once -- row ranges are processed in parallel and merged in order
+    :param file_name: h5 file name
+    :param path: path of the table (of the signed table if unsigned is set)
+    :param unsigned: derive unsigned states from signed states
+    :param limits: activation cutoffs on stored values
+    :param processes: number of processes
+    :return: lstmdata.cell_stats.Accumulator
+    """
+    with h5py.File(file_name, 'r') as h5:
+        length = h5[path].shape[0]
+    bounds = np.linspace(0, length, processes * RANGES_PER_PROCESS + 1).astype(int)
+    tasks = [(file_name, path, unsigned, int(start), int(end), limits)
+             for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    res = None
+    pool = multiprocessing.Pool(processes)
+    for acc in pool.imap(accumulate_range, tasks):
+        if res is None:
+            res = acc
+        else:
+            res.merge(acc)
+        logging.info(' .. %i / %i rows', res.count, length)
+    pool.close()
+    return res
+
+
+def project_stats(project_dir, options):
+    config = configuration(project_dir)
+    stats_dir = os.path.join(project_dir, cs.STATS_DIR_NAME)
+    if not os.path.exists(stats_dir):
+        os.mkdir(stats_dir)
+
+    default_state_file = config['states']['file']
+    for x in config['states']['types']:
+        state_file = x.get('file', default_state_file)
+        source = state_file + '::' + x['path']
+        transform = x.get('transform', 'tanh')
+        file_name = os.path.join(project_dir, config['files'][state_file])
+        logging.info('statistics for %s', source)
+
+        acc = table_stats(file_name, x.get('signed_path', x['path']), 'signed_path' in x,
+                          cs.cutoffs(options.thresholds), options.processes)
+        stats = acc.result(options.thresholds, transform,
+                           [os.path.getmtime(file_name), os.path.getsize(file_name)])
+        cs.write_stats(os.path.join(stats_dir, cs.stats_file_name(source)), stats)
+
+    logging.info('done. Restart the server to serve the statistics at /api/v2/stats.')
+
+
+def stat_info(file, path, options):
+    acc = table_stats(file, path, False, cs.cutoffs(options.thresholds), options.processes)
+    stats = acc.result(options.thresholds, options.transform)
+    print('shape', (acc.count, len(acc.mean)))
+    for key in ['min', 'max', 'mean', 'std']:
+        print(key, stats['global_' + key])
+    for level, value in zip(cs.QUANTILE_LEVELS, stats['global_quantiles']):
+        print('quantile {0:g}'.format(level), value)
+    for threshold, frequency, run_length in zip(options.thresholds, stats['global_active_frequency'],
+                                                stats['global_mean_run_length']):
+        print('threshold {0:g}: active'.format(threshold), frequency, 'mean run length', run_length)
 
-def stat_info(file, path):
-    arr = h5py.File(file)[path][:]
-    print('shape', arr.shape)
-    print('min', arr.min())
-    print('max', arr.max())
-    print('mean', arr.mean())
-    print('std', np.std(arr))
-    print('median', np.median(arr))
 
 def main():
-    parser = OptionParser(usage='%prog <h5_file> <path>\nGives some stats for h5 tables.')
+    parser = OptionParser(usage='%prog [options] <project_directory>\n'
+                                '       %prog [options] <h5_file> <path>\n'
+                                'Computes per-cell statistics of all states of a LSTMVis project '
+                                '(or prints statistics of one h5 table) in one streaming pass.')
+    parser.add_option('-p', help="number of processes (default: number of cores)", type=int,
+                      default=multiprocessing.cpu_count(), dest='processes')
+    parser.add_option('-t', help="comma separated activation thresholds (default: {0})".format(
+        ','.join(str(t) for t in cs.THRESHOLDS)), type=str, default=None, dest='thresholds')
+    parser.add_option('-f', help="transform of a single table: tanh or none (default: tanh)",
+                      type=str, default='tanh', dest='transform')
 
     (options, args) = parser.parse_args()
     logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
-    if len(args) != 2:
-        parser.print_help()
+    options.thresholds = [float(t) for t in options.thresholds.split(',')] if options.thresholds \
+        else list(cs.THRESHOLDS)
+
+    if len(args) == 1:
+        project_stats(args[0], options)
+    elif len(args) == 2:
+        stat_info(args[0], args[1], options)
     else:
-        stat_info(args[0], args[1])
+        parser.print_help()
 
 
 if __name__ == '__main__':
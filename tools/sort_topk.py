@@ -1,35 +1,73 @@
+#! /usr/bin/env python
 from optparse import OptionParser
 
 import h5py
 import logging
+import multiprocessing
 import os
 import numpy as np
 
 __author__ = 'Hendrik Strobelt'
 
+BLOCK_ELEMENTS = int(4e6)  # entries of a table sorted at once
 
-def convert(inFileName, op):
-    inFile = h5py.File(inFileName)
-    filename, file_extension = os.path.splitext(inFileName)
-    outFileName = filename + '_sorted' + file_extension
-    outFile = h5py.File(outFileName, 'w')
 
-    indices = inFile[op.indices][:]
-    scores = inFile[op.scores][:]
+def sort_rows(indices, scores):
+    """
+    sorts each row by descending score
+    :param indices: block of the indices table (rows x k)
+    :param scores: block of the scores table (rows x k)
+    :return: (sorted indices, sorted scores)
+    """
+    order = np.argsort(scores, axis=1, kind='stable')[:, ::-1]
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
 
-    out_indidces = outFile.create_dataset("indices", indices.shape)
-    out_scores = outFile.create_dataset("scores", scores.shape)
+def sort_block(task):
+    """
+    reads and sorts the rows [start, end) -- runs in a worker process
+    :param task: (file name, indices path, scores path, start, end)
+    :return: (start, sorted indices, sorted scores)
+    """
+    file_name, indices_path, scores_path, start, end = task
+    with h5py.File(file_name, 'r') as in_file:
+        return (start,) + sort_rows(in_file[indices_path][start:end], in_file[scores_path][start:end])
 
-    length = min(indices.shape[0], scores.shape[0])
 
-    for i in range(0, length):
-        merged = np.dstack([indices[i], scores[i]])[0]
-        sorted_vec = merged[merged[:, 1].argsort()][::-1]
-        out_indidces[i] = sorted_vec[:, 0]
-        out_scores[i] = sorted_vec[:, 1]
-        if i % 10000 == 0:
-            print i
-    outFile.close()
+def convert(inFileName, op):
+    filename, file_extension = os.path.splitext(inFileName)
+    outFileName = filename + '_sorted' + file_extension
+
+    with h5py.File(inFileName, 'r') as inFile:
+        indices = inFile[op.indices]
+        scores = inFile[op.scores]
+        length = min(indices.shape[0], scores.shape[0])
+        width = indices.shape[1]
+        indices_dtype, scores_dtype = indices.dtype, scores.dtype
+
+    block_rows = max(1, min(length, BLOCK_ELEMENTS // max(1, width)))
+    tasks = [(inFileName, op.indices, op.scores, start, min(length, start + block_rows))
+             for start in range(0, length, block_rows)]
+    chunk_rows = max(1, min(length, (1 << 20) // max(1, width * scores_dtype.itemsize)))
+
+    with h5py.File(outFileName, 'w') as outFile:
+        out_indices = outFile.create_dataset('indices', (length, width), dtype=indices_dtype,
+                                             chunks=(chunk_rows, width), compression='gzip', shuffle=True)
+        out_scores = outFile.create_dataset('scores', (length, width), dtype=scores_dtype,
+                                            chunks=(chunk_rows, width), compression='gzip', shuffle=True)
+
+        pool = multiprocessing.Pool(op.processes) if op.processes > 1 else None
+        blocks = pool.imap_unordered(sort_block, tasks) if pool else map(sort_block, tasks)
+        done = 0
+        for start, sorted_indices, sorted_scores in blocks:
+            out_indices[start:start + len(sorted_indices)] = sorted_indices
+            out_scores[start:start + len(sorted_scores)] = sorted_scores
+            done += len(sorted_indices)
+            logging.info('rows: %i / %i', done, length)
+        if pool:
+            pool.close()
+
+    logging.info('done. Sorted tables written to %s', outFileName)
 
 
 def main():
@@ -38,6 +76,7 @@ def main():
 
     parser.add_option('-i', help="indices table path", type=str, default="indices", dest='indices')
     parser.add_option('-s', help="scores table path", type=str, default="scores", dest='scores')
+    parser.add_option('-p', help="number of processes (default: 1)", type=int, default=1, dest='processes')
 
     (options, args) = parser.parse_args()
     logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+from optparse import OptionParser
+
+import h5py
+import logging
+import os
+import sys
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lstmdata.raw_states as rs
+
+__author__ = 'Hendrik Strobelt'
+
+CONFIG_FILE_NAME = 'lstm.yml'
+
+
+def configuration(project_dir):
+    """
+    checks, if dir and config file exist. if so, returns it as python dict.
+    :param project_dir:
+    :return: config dictionary
+    """
+    config_file_name = os.path.join(project_dir, CONFIG_FILE_NAME)
+    if not os.path.isfile(config_file_name):
+        logging.error('no config file found: %s', config_file_name)
+        sys.exit(-1)
+
+    with open(config_file_name, 'r') as cf:
+        return yaml.load(cf, Loader=yaml.FullLoader)
+
+
+def convert(project_dir, options):
+    config = configuration(project_dir)
+
+    raw_dir = os.path.join(project_dir, rs.RAW_DIR_NAME)
+    if not os.path.exists(raw_dir):
+        os.mkdir(raw_dir)
+    manifest = rs.read_manifest(raw_dir)
+
+    default_state_file = config['states']['file']
+    exported = set()
+    for x in config['states']['types']:
+        state_file = x.get('file', default_state_file)
+        path = x.get('signed_path', x['path'])  # unsigned views are derived from the signed states
+        source = state_file + '::' + path
+        if source in exported:
+            continue
+        file_name = rs.raw_file_name(source)
+        logging.info('exporting %s -> %s', source, file_name)
+        with h5py.File(os.path.join(project_dir, config['files'][state_file]), 'r') as h5:
+            shape, dtype = rs.export(h5[path], os.path.join(raw_dir, file_name), options.dtype,
+                                     x.get('transform', 'tanh'))
+        exported.add(source)
+
+        manifest['sources'][source] = {'file': file_name, 'shape': shape, 'dtype': dtype}
+
+    rs.write_manifest(raw_dir, manifest)
+    logging.info('done. Add "backend: mmap" to the states in your lstm.yml file to use the raw copies.')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] <project_directory>\n'
+                                'Exports all states of a LSTMVis project into memory-mappable .npy files.')
+    parser.add_option('-d', help="output dtype, e.g. float16 or int8 (quantized with per-cell scales) "
+                                 "(default: dtype of the HDF5 table)", type=str, default=None,
+                      dest='dtype')
+
+    (options, args) = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s \t %(message)s', level=logging.INFO)
+    if len(args) != 1:
+        parser.print_help()
+    else:
+        convert(args[0], options)
+
+
+if __name__ == '__main__':
+    main()
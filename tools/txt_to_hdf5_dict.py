@@ -7,19 +7,26 @@ the word indices to the actual words.
 To transform into validation and test with the same dictionary, 
 use model/preprocess.py
 
-Usage: python txt_to_hdf5_dict.py INPUT.txt OUTPUTNAME
+Usage: python txt_to_hdf5_dict.py [-p PROCESSES] INPUT.txt OUTPUTNAME
 
 """
 
 import os
 import sys
 import argparse
+import multiprocessing
 import numpy
 import h5py
 import itertools
+import shutil
+import tempfile
 
 __author__ = 'Sebastian Gehrmann'
 
+CHUNK_TOKENS = 1000000  # tokens converted and written at once
+CHUNK_ROWS = 65536  # HDF5 chunk size of the output datasets
+SPECIAL_WORDS = ["<s>", "<unk>", "</s>"]
+
 
 class Indexer:
     def __init__(self):
@@ -42,52 +49,136 @@ class Indexer:
         items = [(v, k) for k, v in self.d.items()]
         items.sort()
         for v, k in items:
-            print >>out, k, v
+            print(k, v, file=out)
         out.close()
-        
+
+
+def smallest_int_type(max_value):
+    """ smallest signed integer dtype that holds max_value """
+    for dtype in (numpy.int8, numpy.int16, numpy.int32):
+        if max_value <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.int64
+
+
+def shard_bounds(file_name, shards):
+    """ byte ranges of about equal size that start at line beginnings """
+    size = os.path.getsize(file_name)
+    bounds = [0]
+    with open(file_name, "rb") as f:
+        for k in range(1, shards):
+            f.seek(max(bounds[-1], size * k // shards))
+            f.readline()
+            bounds.append(min(size, f.tell()))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def tokenize_shard(task):
+    """
+    converts the lines in a byte range of the text file into ids of a local vocabulary
+    (ids in order of first occurrence) -- runs in a worker process
+    :param task: (text file name, start, end, file name for the ids)
+    :return: (file name for the ids, number of tokens, local vocabulary)
+    """
+    file_name, start, end, ids_file_name = task
+    local = {}
+    count = 0
+    chunk = []
+
+    def flush():
+        ids = numpy.fromiter(map(local.get, chunk, itertools.repeat(-1)), dtype=numpy.int32, count=len(chunk))
+        missing = numpy.flatnonzero(ids < 0)
+        if len(missing):
+            # new words in order of first occurrence
+            new_words = [chunk[i] for i in missing.tolist()]
+            for w in dict.fromkeys(new_words):
+                local[w] = len(local)
+            ids[missing] = numpy.fromiter(map(local.__getitem__, new_words), dtype=numpy.int32, count=len(missing))
+        ids.tofile(ids_file)
+
+    with open(file_name, "rb") as f, open(ids_file_name, "wb") as ids_file:
+        f.seek(start)
+        while f.tell() < end:
+            targ_orig = f.readline().decode("utf-8").replace("<eos>", "")
+            chunk += targ_orig.strip().split()
+            chunk.append("</s>")
+            if len(chunk) >= CHUNK_TOKENS:
+                flush()
+                count += len(chunk)
+                chunk = []
+        flush()
+        count += len(chunk)
+    return ids_file_name, count, list(local)
+
+
+def create_output(f, name, dtype):
+    return f.create_dataset(name, (0,), maxshape=(None,), dtype=dtype, chunks=(CHUNK_ROWS,))
+
+
+def append(dataset, values):
+    dataset.resize((dataset.shape[0] + len(values),))
+    dataset[dataset.shape[0] - len(values):] = values
+
+
 def get_data(args):
     target_indexer = Indexer()
     # add special words to indices in the target_indexer
-    target_indexer.convert("<s>")
-    target_indexer.convert("<unk>")
-    target_indexer.convert("</s>")
-    
-    words = []
-    wordschar = []
-    targets = []
-    for i, targ_orig in enumerate(args.targetfile):
-        targ_orig = targ_orig.replace("<eos>", "")
-        targ = targ_orig.strip().split() + ["</s>"]
-        #here put something for shifting window
-        target_sent = [target_indexer.convert(w) for w in targ]
-        words += target_sent
-    
-    words = numpy.array(words, dtype=int)
+    for w in SPECIAL_WORDS:
+        target_indexer.convert(w)
 
-    # plus 1 for the next word
-    targ_output = numpy.array(words[1:] + [target_indexer.convert("</s>")])
-    original_index = numpy.array([i+1 for i, v in enumerate(words)], dtype=int)
+    # shards are tokenized in parallel with local vocabularies, their ids are kept in temporary files
+    tmp_dir = tempfile.mkdtemp(prefix="txt_to_hdf5_", dir=os.path.dirname(os.path.abspath(args.outputfile)))
+    try:
+        bounds = shard_bounds(args.targetfile, args.processes * 4 if args.processes > 1 else 1)
+        tasks = [(args.targetfile, start, end, os.path.join(tmp_dir, "{0}.ids".format(k)))
+                 for k, (start, end) in enumerate(bounds)]
+        pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+        shards = list(pool.imap(tokenize_shard, tasks) if pool else map(tokenize_shard, tasks))
+        if pool:
+            pool.close()
 
-    print (words.shape, "shape of the word array before preprocessing")
-    
-    # Write output.
-    f = h5py.File(args.outputfile + ".hdf5", "w")
-    f["target"] = words
-    f["indices"] = original_index
-    f["target_output"] = targ_output
-    f["target_size"] = numpy.array([target_indexer.counter])
-    f["set_size"] = words.shape[0]
+        # merging the local vocabularies in shard order gives the ids of a sequential pass
+        mappings = []
+        for _, _, local in shards:
+            mappings.append(numpy.array([target_indexer.convert(w) for w in local], dtype=numpy.int64))
+        length = sum(count for _, count, _ in shards)
+        print((length,), "shape of the word array before preprocessing")
+
+        # Write output.
+        dtype = smallest_int_type(target_indexer.counter)
+        with h5py.File(args.outputfile + ".hdf5", "w") as f:
+            target = create_output(f, "target", dtype)
+            target_output = create_output(f, "target_output", dtype)  # plus 1 for the next word
+            indices = create_output(f, "indices", smallest_int_type(length))
+            for (ids_file_name, count, _), mapping in zip(shards, mappings):
+                for offset in range(0, count, CHUNK_TOKENS):
+                    ids = mapping[numpy.fromfile(ids_file_name, dtype=numpy.int32,
+                                                 count=min(CHUNK_TOKENS, count - offset), offset=offset * 4)]
+                    if target.shape[0] > 0:
+                        target_output[-1] = ids[0]
+                    append(target_output, ids[1:])
+                    append(target_output, [target_indexer.convert("</s>")])
+                    append(indices, numpy.arange(target.shape[0] + 1, target.shape[0] + len(ids) + 1))
+                    append(target, ids)
+            f["target_size"] = numpy.array([target_indexer.counter])
+            f["set_size"] = length
+    finally:
+        shutil.rmtree(tmp_dir)
 
     target_indexer.write(args.outputfile + ".targ.dict")
     
+
 def main(arguments):
     parser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('targetfile', help="Target Input file", 
-                        type=argparse.FileType('r'))
+                        type=str)
     parser.add_argument('outputfile', help="Output file name", 
                         type=str)
+    parser.add_argument('-p', '--processes', help="number of processes that tokenize shards of the input",
+                        type=int, default=1)
     args = parser.parse_args(arguments)
     get_data(args)
 